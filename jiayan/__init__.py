@@ -1,13 +1,43 @@
-import kenlm
+import sys
+from importlib import import_module
 
-from jiayan.lexicon.pmi_entropy_constructor import PMIEntropyLexiconConstructor
-from jiayan.tokenizer.hmm_tokenizer import CharHMMTokenizer
-from jiayan.tokenizer.ngram_tokenizer import WordNgramTokenizer
-from jiayan.sentencizer.crf_sentencizer import CRFSentencizer
-from jiayan.sentencizer.crf_punctuator import CRFPunctuator
-from jiayan.postagger.crf_pos_tagger import CRFPOSTagger
+from jiayan.lm import CachedLM, DEFAULT_CACHE_SIZE
 
+"""
+The components are imported on first access (PEP 562), and kenlm, pycrfsuite and sklearn only where they are used,
+so e.g. "from jiayan import WordNgramTokenizer" does not pay for the whole ML stack, nor need it installed.
+"""
 
-def load_lm(lm):
-    return kenlm.LanguageModel(lm)
+# the lazily imported names and their modules
+_lazy_imports = {
+    'PMIEntropyLexiconConstructor': 'jiayan.lexicon.pmi_entropy_constructor',
+    'CharHMMTokenizer': 'jiayan.tokenizer.hmm_tokenizer',
+    'WordNgramTokenizer': 'jiayan.tokenizer.ngram_tokenizer',
+    'CRFSentencizer': 'jiayan.sentencizer.crf_sentencizer',
+    'CRFPunctuator': 'jiayan.sentencizer.crf_punctuator',
+    'CRFPOSTagger': 'jiayan.postagger.crf_pos_tagger',
+}
 
+__all__ = ['CachedLM', 'DEFAULT_CACHE_SIZE', 'load_lm'] + list(_lazy_imports)
+
+
+def __getattr__(name):
+    if name in _lazy_imports:
+        value = getattr(import_module(_lazy_imports[name]), name)
+        # cache it, so later accesses do not come here,
+        # through the module, for "globals" is shadowed by the jiayan.globals submodule once imported
+        setattr(sys.modules[__name__], name, value)
+        return value
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(vars(sys.modules[__name__])) | set(_lazy_imports))
+
+
+def load_lm(lm, cache_size=DEFAULT_CACHE_SIZE):
+    """ Loads a kenlm language model, with a segment score cache of given size shared by the components using it.
+    """
+    import kenlm
+
+    return CachedLM(kenlm.LanguageModel(lm), cache_size)
@@ -0,0 +1,201 @@
+import argparse
+import fileinput
+import json
+import os
+import sys
+
+from jiayan.parallel import DEFAULT_CHUNKSIZE, imap_chunks
+
+"""
+Command line entry point, e.g.
+
+    $ python -m jiayan tokenize --lm jiayan.klm corpus.txt -o words.jsonl --workers 8
+    $ python -m jiayan tokenize --emissions jiayan.emissions corpus.txt -o words.jsonl
+    $ cat corpus.txt | python -m jiayan punctuate --lm jiayan.klm --cut-model cut_model --punc-model punc_model
+    $ python -m jiayan postag --pos-model pos_model words.txt --format tsv
+    $ python -m jiayan lexicon corpus.txt -o lexicon.csv
+    $ python -m jiayan lexicon new.txt -o lexicon.csv --counts corpus.counts
+    $ python -m jiayan lexicon -o lexicon.csv --counts corpus.counts --min-pmi 80 --min-pmi 4:40 --top-k 1000
+
+Each non-empty input line is a document (for postag, a line of whitespace separated words), read lazily from the
+given files or stdin, and each result is written as one output line in input order, so corpora of any size are
+processed with bounded memory. The models are loaded once, and shared with the worker processes.
+"""
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='jiayan', description='The NLP toolkit designed for classical chinese.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    def add_command(name, help_msg):
+        subparser = subparsers.add_parser(name, help=help_msg)
+        subparser.add_argument('files', nargs='*', help='input files, read stdin if not given or "-"')
+        subparser.add_argument('-o', '--output', help='output file, write stdout if not given')
+        subparser.add_argument('--format', choices=['jsonl', 'tsv'], default='jsonl', help='output format')
+        subparser.add_argument('--workers', type=int, default=1, help='number of worker processes, 0 for all cores')
+        subparser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE,
+                               help='number of lines sent to a worker at a time')
+        return subparser
+
+    tokenize = add_command('tokenize', 'tokenize lines into words')
+    tokenize.add_argument('--method', choices=['hmm', 'ngram'], default='hmm',
+                          help='char HMM tokenizer with a language model, or word N-grams tokenizer with a dict')
+    tokenize.add_argument('--lm', help='kenlm language model, required by the hmm method')
+    tokenize.add_argument('--emissions', help='emission table of the hmm method, used instead of --lm')
+    tokenize.add_argument('--dict', help='word frequency dict of the ngram method, the builtin one if not given')
+
+    sentencize = add_command('sentencize', 'split unpunctuated lines into sentences')
+    sentencize.add_argument('--lm', required=True, help='kenlm language model')
+    sentencize.add_argument('--cut-model', required=True, help='CRF sentencizer model')
+
+    punctuate = add_command('punctuate', 'punctuate unpunctuated lines')
+    punctuate.add_argument('--lm', required=True, help='kenlm language model')
+    punctuate.add_argument('--cut-model', required=True, help='CRF sentencizer model')
+    punctuate.add_argument('--punc-model', required=True, help='CRF punctuator model')
+
+    postag = add_command('postag', 'POS tag lines of whitespace separated words')
+    postag.add_argument('--pos-model', required=True, help='CRF POS tagger model')
+
+    lexicon = subparsers.add_parser('lexicon', help='construct a lexicon from a corpus file')
+    lexicon.add_argument('file', nargs='?', help='input corpus file, may be omitted to filter the --counts file')
+    lexicon.add_argument('-o', '--output', required=True, help='output csv file')
+    lexicon.add_argument('--workers', type=int, default=1,
+                         help='number of worker processes counting the corpus by shards, 0 for all cores')
+    lexicon.add_argument('--max-memory', type=int,
+                         help='count out of core, with about this many MB of n-grams in memory in each process')
+    lexicon.add_argument('--temp-dir', help='dir of the temp files counting out of core')
+    lexicon.add_argument('--approx-memory', type=int,
+                         help='count approximately in about this many MB, a Count-Min sketch and the candidate words, '
+                              'reading the corpus twice')
+    lexicon.add_argument('--counts', help='n-gram counts file, the corpus is merged into it if it exists, '
+                                          'and the counts are saved to it')
+    lexicon.add_argument('--top-k', type=int, help='only output the top K words of each length')
+    for option, help_msg in (('--min-freq', 'min word freq'), ('--min-pmi', 'min PMI'),
+                             ('--min-entropy', 'min right and left entropy')):
+        lexicon.add_argument(option, type=length_threshold, action='append', metavar='[LEN:]VALUE',
+                             help=help_msg + ', of all lengths, or of words of LEN chars, may be repeated')
+
+    return parser
+
+
+def length_threshold(arg):
+    """ Parses a threshold "VALUE" of all the word lengths, or "LEN:VALUE" of one length, as (LEN or None, VALUE).
+    """
+    length, _, value = arg.rpartition(':')
+    try:
+        return int(length) if length else None, int(value) if value.lstrip('-').isdigit() else float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid threshold: {}'.format(arg))
+
+
+def set_thresholds(constructor, args):
+    for thresholds, name, length_name in ((args.min_freq, 'MIN_WORD_FREQ', 'MIN_WORD_FREQS'),
+                                          (args.min_pmi, 'MIN_PMI', 'MIN_PMIS'),
+                                          (args.min_entropy, 'MIN_ENTROPY', 'MIN_ENTROPIES')):
+        length_thresholds = dict(getattr(constructor, length_name))
+        for length, value in thresholds or []:
+            if length is None:
+                setattr(constructor, name, value)
+            else:
+                length_thresholds[length] = value
+        setattr(constructor, length_name, length_thresholds)
+
+
+def load_component(args, parser):
+    """ Loads the models of the command once, returns the component and the method to apply to each document. """
+    from jiayan import load_lm, CharHMMTokenizer, WordNgramTokenizer, CRFSentencizer, CRFPunctuator, CRFPOSTagger
+
+    if args.command == 'tokenize':
+        if args.method == 'ngram':
+            return WordNgramTokenizer(args.dict), 'tokenize'
+        if args.emissions:
+            return CharHMMTokenizer(emission_table=args.emissions), 'tokenize'
+        if not args.lm:
+            parser.error('the hmm method requires --lm or --emissions')
+        return CharHMMTokenizer(load_lm(args.lm)), 'tokenize'
+
+    if args.command == 'sentencize':
+        sentencizer = CRFSentencizer(load_lm(args.lm))
+        sentencizer.load(args.cut_model)
+        return sentencizer, 'sentencize'
+
+    if args.command == 'punctuate':
+        punctuator = CRFPunctuator(load_lm(args.lm), args.cut_model)
+        punctuator.load(args.punc_model)
+        return punctuator, 'punctuate'
+
+    postagger = CRFPOSTagger()
+    postagger.load(args.pos_model)
+    return postagger, 'postag'
+
+
+def read_docs(args):
+    """ Yields the documents of the input files or stdin lazily. """
+    with fileinput.input(args.files, openhook=fileinput.hook_encoded('utf-8')) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line.split() if args.command == 'postag' else line
+
+
+def format_result(doc, result, out_format):
+    if out_format == 'jsonl':
+        if isinstance(doc, list):
+            result = list(zip(doc, result))
+        return json.dumps(result, ensure_ascii=False)
+
+    # tsv: tokens or sentences separated by tabs, or the words and tags like the POS training data
+    if isinstance(doc, list):
+        return ' '.join(doc) + '\t' + ' '.join(result)
+    if isinstance(result, list):
+        return '\t'.join(result)
+    return result
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.command == 'lexicon':
+        if args.approx_memory and args.counts:
+            parser.error('approximate counts are not able to be saved to --counts')
+        from jiayan import PMIEntropyLexiconConstructor
+        from jiayan.lexicon.ngram_counter import NGRAM_BYTES
+
+        if args.counts and os.path.isfile(args.counts):
+            constructor = PMIEntropyLexiconConstructor.load_counts(args.counts)
+            set_thresholds(constructor, args)
+            if args.file:
+                constructor.merge_counts(args.file, args.workers or None)
+        elif args.file:
+            max_ngrams = args.max_memory * 2 ** 20 // NGRAM_BYTES if args.max_memory else None
+            sketch_memory = args.approx_memory * 2 ** 20 if args.approx_memory else None
+            constructor = PMIEntropyLexiconConstructor(max_ngrams, args.temp_dir, sketch_memory)
+            set_thresholds(constructor, args)
+            constructor.count_ngrams(args.file, args.workers or None)
+            constructor.compute()
+        else:
+            parser.error('the lexicon command requires an input file or an existing --counts file')
+        if args.counts and args.file:
+            constructor.save_counts(args.counts)
+        constructor.save_lexicon(args.output, args.top_k)
+        return
+
+    component, method = load_component(args, parser)
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        for docs, results in imap_chunks(component, method, read_docs(args), args.workers or None, args.chunksize):
+            for doc, result in zip(docs, results):
+                out.write(format_result(doc, result, args.format) + '\n')
+    except BrokenPipeError:
+        # the reader stopped early, e.g. piped to head
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from jiayan.lexicon.pmi_entropy_constructor import PMIEntropyLexiconConstructor
+from jiayan.lm import CachedLM
+from jiayan.sentencizer.crf_punctuator import CRFPunctuator
+from jiayan.tokenizer.hmm_tokenizer import CharHMMTokenizer
+from jiayan.tokenizer.ngram_tokenizer import WordNgramTokenizer
+from jiayan.utils import text_iterator
+
+"""
+Rough timings of the hot paths, run with `python -m jiayan.benchmarks`.
+"""
+
+
+def timeit(func, *args, repeat=3):
+    """ Returns the best wall time of several runs of the given function. """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        cost = time.perf_counter() - start
+        if best is None or cost < best:
+            best = cost
+    return best
+
+
+def dict_viterbi(tokenizer, emits):
+    """ The path-string based viterbi CharHMMTokenizer used before, kept as a reference. """
+    states = tokenizer.states
+    paths = {state: prob + tokenizer.inits[state] for state, prob in zip(states, emits[0])}
+    for i in range(1, len(emits)):
+        cur_char_paths = {}
+        for state, emit_prob in zip(states, emits[i]):
+            cur_state_paths = {}
+            for path, path_prob in paths.items():
+                trans_states = path[-1] + state
+                if trans_states in tokenizer.trans:
+                    cur_state_paths[path + state] = path_prob + emit_prob + tokenizer.trans[trans_states]
+            best_path = sorted(cur_state_paths, key=lambda x: cur_state_paths[x])[-1]
+            cur_char_paths[best_path] = cur_state_paths[best_path]
+        paths = cur_char_paths
+    return sorted(paths, key=lambda x: paths[x])[-1]
+
+
+def bench_viterbi(lengths=(1000, 10000, 100000), max_dict_length=20000):
+    """ Compares the array based viterbi with the dict based one on random emissions, the dict based one is
+        quadratic, so it is skipped on inputs longer than max_dict_length.
+    """
+    random.seed(42)
+    tokenizer = CharHMMTokenizer(None)
+
+    print('{:>8} {:>12} {:>12} {:>8}'.format('chars', 'dict (s)', 'array (s)', 'speedup'))
+    for length in lengths:
+        emits = [tuple(random.uniform(-6, -0.5) for _ in range(4)) for _ in range(length)]
+        array_time = timeit(tokenizer.decode, emits)
+        if length <= max_dict_length:
+            assert dict_viterbi(tokenizer, emits) == tokenizer.decode(emits)
+            dict_time = timeit(dict_viterbi, tokenizer, emits, repeat=1)
+            print('{:>8} {:>12.4f} {:>12.4f} {:>7.1f}x'.format(length, dict_time, array_time, dict_time / array_time))
+        else:
+            print('{:>8} {:>12} {:>12.4f} {:>8}'.format(length, '-', array_time, '-'))
+
+
+def bench_lm_cache(lm, data_file, cache_size=2 ** 16):
+    """ Tokenizes a corpus with the HMM tokenizer, reports how many segment scores the cache saved. """
+    lm = CachedLM(lm, cache_size)
+    tokenizer = CharHMMTokenizer(lm)
+
+    start = time.perf_counter()
+    for text in text_iterator(data_file):
+        for _ in tokenizer.tokenize(text):
+            pass
+    cost = time.perf_counter() - start
+
+    calls = lm.hits + lm.misses
+    print('segment scores: {}, lm calls: {}, hit rate: {:.2%}, time: {:.4f}s'.format(
+        calls, lm.misses, lm.hits / (calls or 1), cost))
+
+
+def bench_emissions(lm, data_file):
+    """ Compares emission probs by re-scoring every window prefix with the state carrying cond_probs. """
+    lm = CachedLM(lm, 0)
+    tokenizer = CharHMMTokenizer(lm)
+    seg_prob = tokenizer.seg_prob
+    texts = list(text_iterator(data_file))
+
+    def rescore():
+        for sent in texts:
+            [(seg_prob(sent[i]), seg_prob(sent[i - 1:i + 1]), seg_prob(sent[i - 2:i + 1]), seg_prob(sent[i - 3:i + 1]))
+             for i in range(len(sent))]
+
+    def carry():
+        for sent in texts:
+            lm.cond_probs(sent)
+
+    rescore_time = timeit(rescore, repeat=1)
+    carry_time = timeit(carry, repeat=1)
+    print('chars: {}, re-scoring: {:.4f}s, state carrying: {:.4f}s, speedup: {:.1f}x'.format(
+        sum(map(len, texts)), rescore_time, carry_time, rescore_time / carry_time))
+
+
+def bench_emission_table(lm, data_file, table_f):
+    """ Compares tokenizing with the live language model and with the emission table compiled from the texts, both
+        on the texts one by one and on texts of 30 joined together.
+    """
+    from jiayan.tokenizer.emission_table import EmissionTable
+
+    EmissionTable.compile(lm, text_iterator(data_file)).save(table_f)
+    texts = list(text_iterator(data_file))
+    long_texts = [''.join(texts[i:i + 30]) for i in range(0, len(texts), 30)]
+    chars = sum(map(len, texts))
+    for name, tokenizer in (('lm', CharHMMTokenizer(CachedLM(lm, 0))), ('table', CharHMMTokenizer(None, table_f))):
+        for kind, data in (('short', texts), ('long', long_texts)):
+            cost = timeit(lambda: [list(tokenizer.tokenize(text)) for text in data], repeat=1)
+            print('{} {}: {:.2f}s, {:.0f} chars/s'.format(name, kind, cost, chars / cost))
+
+
+def bench_prefix_index(data_file, dict_f=None, cache_dir=None):
+    """ Compares the build time, cached load time, memory and tokenizing time of the prefix indexes of
+        WordNgramTokenizer.
+    """
+    texts = list(text_iterator(data_file))
+    results = {}
+    for index in ('dict', 'trie', 'automaton'):
+        # the first load builds the cache
+        WordNgramTokenizer(dict_f, index, cache_dir).clear_cache(userdict=False)
+        build_time = timeit(WordNgramTokenizer, dict_f, index, cache_dir, repeat=1)
+        load_time = timeit(WordNgramTokenizer, dict_f, index, cache_dir, repeat=1)
+
+        tracemalloc.start()
+        tokenizer = WordNgramTokenizer(dict_f, index, cache_dir)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        results[index] = [list(tokenizer.tokenize(text)) for text in texts]
+        tokenize_time = timeit(lambda: [list(tokenizer.tokenize(text)) for text in texts])
+        print('{}: build {:.4f}s, cached load {:.4f}s, memory {:.1f}MB, tokenize {:.4f}s'.format(
+            index, build_time, load_time, memory / 2 ** 20, tokenize_time))
+    assert results['dict'] == results['trie'] == results['automaton']
+
+
+def bench_ngram_tokenize(texts=None, dict_f=None, cache_dir=None, repeat=5):
+    """ Reports the tokenizing throughput of WordNgramTokenizer with each prefix index, in chars/s, on the texts, the
+        example texts of jiayan.examples by default.
+    """
+    if texts is None:
+        from jiayan.examples import EXAMPLE_TEXTS as texts
+
+    chars = sum(map(len, texts))
+    for index in ('dict', 'trie', 'automaton'):
+        tokenizer = WordNgramTokenizer(dict_f, index, cache_dir)
+        # enough rounds of the texts for about a million chars
+        rounds = max(1, 10 ** 6 // max(chars, 1))
+        cost = timeit(lambda: [list(tokenizer.tokenize(text)) for _ in range(rounds) for text in texts],
+                      repeat=repeat)
+        print('{}: {} chars, {:.0f} chars/s'.format(index, chars, chars * rounds / cost))
+
+
+def bench_approx_lexicon(data_file, memories=(4, 16, 64, 256)):
+    """ Compares the lexicons constructed with the n-grams counted approximately in some MB, with the exact lexicon:
+        the recall of the exact words, and the max entropy underestimate of the words found, next to the number of
+        the n-grams counted exactly, the min estimate of the candidates, and the peak memory traced, to choose a
+        memory for a corpus from.
+    """
+    def construct(sketch_memory=None):
+        start = time.perf_counter()
+        constructor = PMIEntropyLexiconConstructor(sketch_memory=sketch_memory)
+        constructor.count_ngrams(data_file)
+        constructor.compute()
+        lexicon = dict(constructor.iter_words())
+        return constructor, lexicon, time.perf_counter() - start
+
+    def peak_memory(sketch_memory=None):
+        tracemalloc.start()
+        construct(sketch_memory)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak / 2 ** 20
+
+    constructor, exact, exact_time = construct()
+    print('exact: {} words, {} n-grams, peak {:.1f}MB, {:.2f}s'.format(
+        len(exact), len(constructor.table), peak_memory(), exact_time))
+    for memory in memories:
+        constructor, lexicon, cost = construct(memory * 2 ** 20)
+        found = [word for word in lexicon if word in exact]
+        assert len(found) == len(lexicon)
+        assert all(lexicon[word][:2] == exact[word][:2] for word in found)
+        error = max([max(exact[word][2] - lexicon[word][2], exact[word][3] - lexicon[word][3]) for word in found] +
+                    [0])
+        print('{}MB: recall {:.2%}, max entropy underestimate {:.4f}, {} candidates estimated at least {} times, '
+              'peak {:.1f}MB, {:.2f}s'.format(memory, len(found) / (len(exact) or 1), error, len(constructor.table),
+                                              constructor.counter.min_estimate, peak_memory(memory * 2 ** 20), cost))
+
+
+def bench_punctuate(lm, cut_model, punc_model, data_file, lines=10):
+    """ Compares the latency of punctuating long texts, each of some lines of the file joined, with the features
+        computed once for both the sentencizer and the punctuator, and computed for each of them.
+    """
+    punctuator = CRFPunctuator(lm, cut_model)
+    punctuator.load(punc_model)
+    sentencizer = punctuator.sentencizer
+    texts = list(text_iterator(data_file))
+    texts = [''.join(texts[i:i + lines]) for i in range(0, len(texts), lines)]
+    chars = sum(map(len, texts))
+
+    def shared():
+        for text in texts:
+            columns = {}
+            cut_tags = sentencizer.tagger.tag(sentencizer.sent2items(text, columns=columns))
+            punctuator.tagger.tag(punctuator.sent2items(text, cut_tags, columns))
+
+    def separate():
+        for text in texts:
+            cut_tags = sentencizer.tagger.tag(sentencizer.sent2items(text))
+            punctuator.tagger.tag(punctuator.sent2items(text, cut_tags))
+
+    separate_time = timeit(separate)
+    shared_time = timeit(shared)
+    print('texts: {}, avg chars: {:.1f}'.format(len(texts), chars / (len(texts) or 1)))
+    for name, cost in (('separate features', separate_time), ('shared features', shared_time)):
+        print('{}: {:.4f}s, {:.2f}ms per text, {:.0f} chars/s'.format(
+            name, cost, cost * 1000 / (len(texts) or 1), chars / cost))
+
+
+def bench_training_features(tagger, data_file, workers=(1, 2, 4, 8)):
+    """ Compares the time of making the training examples of a corpus file by some numbers of workers, with a
+        tagger, e.g. a CRFSentencizer, and checks the examples are the same in the same order.
+    """
+    def make_examples(n):
+        count = 0
+        checksum = 0
+        for feat_list, tag_list in tagger.iter_data(data_file, n):
+            count += 1
+            checksum = hash((checksum, len(feat_list), tuple(tag_list)))
+        return count, checksum
+
+    expected = None
+    base_time = None
+    for n in workers:
+        start = time.perf_counter()
+        result = make_examples(n)
+        cost = time.perf_counter() - start
+        if expected is None:
+            expected, base_time = result, cost
+        assert result == expected
+        print('{} workers: {} examples, {:.2f}s, speedup {:.2f}x'.format(n, result[0], cost, base_time / cost))
+
+
+IMPORT_STATEMENTS = (
+    'import jiayan',
+    'from jiayan import WordNgramTokenizer',
+    'from jiayan import CharHMMTokenizer, load_lm',
+    'from jiayan import CRFSentencizer, CRFPunctuator, CRFPOSTagger',
+    'from jiayan import load_lm; import pycrfsuite, sklearn.metrics',
+)
+
+
+def bench_import_time(statements=IMPORT_STATEMENTS, repeat=5):
+    """ Reports the wall time of each import statement in a fresh interpreter, less the interpreter startup. """
+    def run(statement):
+        return subprocess.run([sys.executable, '-c', statement], check=True)
+
+    startup = timeit(run, 'pass', repeat=repeat)
+    for statement in statements:
+        cost = timeit(run, statement, repeat=repeat) - startup
+        print('{:.1f}ms: {}'.format(cost * 1000, statement))
+
+
+if __name__ == '__main__':
+    bench_viterbi()
+    bench_import_time()
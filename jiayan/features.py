@@ -0,0 +1,111 @@
+"""
+Feature templates of the CRF taggers.
+
+A template gets a feature of each position i of a sentence from a window of the sentence, e.g. "-10:chars" is the
+bigram sent[i - 1: i + 1], and the feature is "-10:chars=" + the bigram, only if the whole window is in the sentence.
+Instead of slicing the windows again and again for each position, the n-grams of a sentence are sliced once, each
+shared by all the templates of its size, and the other columns of values, e.g. the LM scores, are computed by the
+taggers for a whole sentence at once.
+
+The features of a position only depend on how many units are before and after it, up to the longest reaches of the
+windows, so the templates of each such case are resolved once into a function building the list of features from the
+columns with the names, sources and offsets precomputed, and all the positions in the middle of a sentence share one.
+
+The feature strings are the same as the ones the models are trained with. They are not given to crfsuite as dicts of
+names and values, for crfsuite takes {"-10:chars": "天下"} as "-10:chars:天下", not "-10:chars=天下".
+"""
+
+from itertools import repeat
+
+
+class FeatureTemplates:
+
+    def __init__(self, templates, sep='', sizes=None):
+        """ Each template is one of:
+                "name": a feature of all the positions, e.g. "bias";
+                ("name", offset): a feature of the positions whose position + offset is out of the sentence, e.g.
+                    ("BOS", -1) of the first position;
+                ("name", source, offset): the feature "name=value" of the value of the source column at position +
+                    offset, if the window of the value is in the sentence.
+            The sources are:
+                "gram1" ... "gram4": the n-grams of the units, joined by sep;
+                "skip": the units before and after a window of 3, joined by sep;
+                and the columns given to features(), e.g. the LM scores, whose window sizes are in sizes.
+            The features of a position are in the order of the templates.
+        """
+        self.templates = templates
+        self.sep = sep
+        self.sizes = {'skip': 3, 'gram1': 1, 'gram2': 2, 'gram3': 3, 'gram4': 4}
+        self.sizes.update(sizes or {})
+        self.sources = sorted({template[1] for template in templates if isinstance(template, tuple) and
+                               len(template) == 3})
+
+        # the longest reaches of the windows before and after a position
+        self.left = 0
+        self.right = 0
+        for template in templates:
+            if isinstance(template, tuple):
+                offset = template[-1]
+                size = self.sizes[template[1]] if len(template) == 3 else 1
+                self.left = max(self.left, -offset)
+                self.right = max(self.right, offset + size - 1)
+
+        self.row_functions = {}
+
+    def values(self, units, source):
+        """ The values of a builtin source, of the windows starting at each position. """
+        if source == 'skip':
+            return [units[j] + self.sep + units[j + 2] for j in range(len(units) - 2)]
+        n = self.sizes[source]
+        if n == 1:
+            return units
+        if isinstance(units, str):
+            return [units[j: j + n] for j in range(len(units) - n + 1)]
+        return [self.sep.join(units[j: j + n]) for j in range(len(units) - n + 1)]
+
+    def row_function(self, before, after):
+        """ The function building the features of a position with the given numbers of units before and after it,
+            from the position and the source columns. Each feature is a tuple (text, source index, offset), whose
+            source index is None if the feature is the text itself, e.g. of the last char of a sentence:
+                [('bias', None, 0), ('0:char=', 0, 0), ('-10:chars=', 1, -1), ('EOS', None, 0)]
+        """
+        key = (min(before, self.left), min(after, self.right))
+        if key not in self.row_functions:
+            features = []
+            for template in self.templates:
+                if isinstance(template, str):
+                    features.append((template, None, 0))
+                elif len(template) == 2:
+                    if not -before <= template[1] <= after:
+                        features.append((template[0], None, 0))
+                else:
+                    name, source, offset = template
+                    if -before <= offset and offset + self.sizes[source] - 1 <= after:
+                        features.append((name + '=', self.sources.index(source), offset))
+
+            def row(i, *sources):
+                return [text if k is None else text + sources[k][i + offset] for text, k, offset in features]
+
+            self.row_functions[key] = row
+        return self.row_functions[key]
+
+    def features(self, units, columns=None):
+        """ The lists of the feature strings of all the positions of the units, a string or a list of words, with the
+            dict of the columns of the other sources, e.g. features(sent, {'pmi': pmis}). The builtin sources are
+            added to the dict, so other templates of the same sep given the dict of the same units reuse them.
+        """
+        length = len(units)
+        if columns is None:
+            columns = {}
+        for source in self.sources:
+            if source not in columns:
+                columns[source] = self.values(units, source)
+        sources = [columns[source] for source in self.sources]
+        start = min(self.left, length)
+        end = max(length - self.right, start)
+
+        rows = [self.row_function(i, length - 1 - i)(i, *sources) for i in range(start)]
+        # all the windows of the positions away from the sentence ends are in the sentence
+        rows.extend(map(self.row_function(self.left, self.right), range(start, end), *map(repeat, sources)))
+        rows.extend(self.row_function(i, length - 1 - i)(i, *sources) for i in range(end, length))
+        return rows
@@ -0,0 +1,262 @@
+import heapq
+import os
+import shutil
+import tempfile
+import weakref
+from array import array
+from itertools import groupby, islice
+from operator import itemgetter
+
+import numpy as np
+
+from jiayan.utils import line_texts, text_iterator
+
+"""
+Char N-grams counting for new words discovery.
+
+All the 1 ... max_len grams of the texts are counted in one flat dict of n-gram strings, instead of a trie of node
+objects and a reversed trie for the left contexts: the right neighbors of an n-gram w are the n+1-grams w + c, and
+the left neighbors are the n+1-grams c + w, which are all in the same dict, so every n-gram is stored only once.
+
+A big corpus file could be counted in parallel: it is split into byte ranges at line ends, each range is counted by a
+worker process, and the counts are merged in file order, so the merged dict is exactly the one counted in one process.
+
+A corpus whose n-grams do not fit in memory is counted by ExternalNgramCounter: at most max_ngrams n-grams are counted
+in memory at a time, then spilled to disk as a run sorted by n-gram, and all the runs are k-way merged into one sorted
+file of "ngram\tfreq" lines, which is read as a stream of (ngram, freq) pairs.
+"""
+
+# about the memory of an n-gram counted in the dict, with its key string and count
+NGRAM_BYTES = 120
+
+DEFAULT_MAX_NGRAMS = 2 ** 22
+
+# the most runs merged at a time, so the open files are bounded
+MERGE_FAN_IN = 64
+
+
+class NgramCounter:
+
+    def __init__(self, max_len):
+        self.max_len = max_len
+        self.counts = {}
+        self.total = 0
+
+    def __getstate__(self):
+        # much faster to pickle than a dict of many small strings, to send the counts back from the workers;
+        # the n-grams are zh chars, never line breaks
+        return self.max_len, self.total, '\n'.join(self.counts), array('q', self.counts.values())
+
+    def __setstate__(self, state):
+        self.max_len, self.total, ngrams, freqs = state
+        self.counts = dict(zip(ngrams.split('\n'), freqs)) if ngrams else {}
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __contains__(self, ngram):
+        return ngram in self.counts
+
+    def __getitem__(self, ngram):
+        return self.counts[ngram]
+
+    def get(self, ngram, default=0):
+        return self.counts.get(ngram, default)
+
+    def items(self):
+        return self.counts.items()
+
+    def batches(self, size):
+        """ Yields the counted n-grams in batches of (n-grams list, freqs array). """
+        ngrams = iter(self.counts)
+        freqs = iter(self.counts.values())
+        for batch in iter(lambda: list(islice(ngrams, size)), []):
+            yield batch, np.fromiter(islice(freqs, len(batch)), np.int64, len(batch))
+
+    def add(self, text):
+        """ Counts all the n-grams of a text. """
+        counts = self.counts
+        max_len = self.max_len
+        length = len(text)
+        for i in range(length):
+            end = min(length, i + max_len)
+            for j in range(i + 1, end + 1):
+                seg = text[i:j]
+                counts[seg] = counts.get(seg, 0) + 1
+            self.total += end - i
+
+    def count_file(self, data_file, workers=1):
+        """ Counts the n-grams of a corpus file. If workers is not 1, the file is split into as many shards as
+            workers, counted by a pool of worker processes, as many as cpu cores if workers is None.
+        """
+        if workers == 1:
+            for text in text_iterator(data_file):
+                self.add(text)
+            return
+
+        # multiprocessing takes a while to import, and is not needed by a single worker
+        from multiprocessing import Pool
+
+        workers = workers or os.cpu_count()
+        shards = [(data_file, start, end, self.max_len) for start, end in file_shards(data_file, workers)]
+        with Pool(workers) as pool:
+            # in file order, so the n-grams are inserted in the same order as counted in one process
+            for counter in pool.imap(_count_shard, shards):
+                self.update(counter)
+
+    def update(self, other):
+        """ Adds the counts of another counter, the new n-grams are inserted in the order of the other counter.
+        """
+        counts = self.counts
+        get = counts.get
+        for ngram, freq in other.items():
+            counts[ngram] = get(ngram, 0) + freq
+        self.total += other.total
+
+
+class ExternalNgramCounter:
+    """ Counts n-grams in bounded memory: the memory of counting is about max_ngrams * NGRAM_BYTES in each process,
+        however big the corpus is, and the counted n-grams are only iterated in sorted order with items().
+        The temp files are in a new dir in temp_dir, removed by close() or when the counter is gone.
+    """
+
+    def __init__(self, max_len, max_ngrams=DEFAULT_MAX_NGRAMS, temp_dir=None):
+        self.max_len = max_len
+        self.max_ngrams = max_ngrams
+        self.total = 0
+
+        self.temp_dir = tempfile.mkdtemp(prefix='jiayan.', dir=temp_dir)
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.temp_dir, True)
+        self.runs = []
+        self.merged = None
+
+    def close(self):
+        self._finalizer()
+
+    def items(self):
+        """ Yields (ngram, freq) pairs of the counted n-grams, sorted by n-gram. """
+        if self.runs or self.merged is None:
+            self.merge()
+        for item in read_run(self.merged):
+            yield item
+
+    def batches(self, size):
+        """ Yields the counted n-grams sorted, in batches of (n-grams list, freqs array). """
+        items = self.items()
+        for batch in iter(lambda: list(islice(items, size)), []):
+            ngrams, freqs = zip(*batch)
+            yield list(ngrams), np.array(freqs, dtype=np.int64)
+
+    def count_file(self, data_file, workers=1):
+        """ Counts the n-grams of a corpus file, in a pool of workers if workers is not 1, then each worker spills
+            its own runs with its own memory budget.
+        """
+        if workers == 1:
+            runs, total = _spill_texts(text_iterator(data_file), self.max_len, self.max_ngrams, self.temp_dir)
+            self.runs.extend(runs)
+            self.total += total
+        else:
+            from multiprocessing import Pool
+
+            workers = workers or os.cpu_count()
+            shards = [(data_file, start, end, self.max_len, self.max_ngrams, self.temp_dir)
+                      for start, end in file_shards(data_file, workers)]
+            with Pool(workers) as pool:
+                for runs, total in pool.imap(_spill_shard, shards):
+                    self.runs.extend(runs)
+                    self.total += total
+
+    def merge(self):
+        """ Merges all the runs into one sorted run, at most MERGE_FAN_IN runs at a time. """
+        runs = self.runs + ([self.merged] if self.merged else [])
+        if not runs:
+            runs = [write_run([], self.temp_dir)]
+        while len(runs) > 1:
+            group, runs = runs[:MERGE_FAN_IN], runs[MERGE_FAN_IN:]
+            runs.append(write_run(merge_runs(group), self.temp_dir))
+            for run in group:
+                os.remove(run)
+        self.runs = []
+        self.merged = runs[0]
+
+
+def write_run(items, temp_dir):
+    """ Writes sorted (ngram, freq) pairs into a new run file, returns its path. """
+    fd, run = tempfile.mkstemp(suffix='.run', dir=temp_dir)
+    with open(fd, 'w', encoding='utf-8') as f:
+        for ngram, freq in items:
+            f.write('{}\t{}\n'.format(ngram, freq))
+    return run
+
+
+def read_run(run):
+    with open(run, 'r', encoding='utf-8') as f:
+        for line in f:
+            ngram, freq = line.split('\t')
+            yield ngram, int(freq)
+
+
+def merge_runs(runs):
+    """ Merges sorted runs, yields (ngram, freq) pairs sorted by n-gram, with the freqs in all the runs summed up. """
+    merged = heapq.merge(*[read_run(run) for run in runs], key=itemgetter(0))
+    for ngram, items in groupby(merged, key=itemgetter(0)):
+        yield ngram, sum(freq for _, freq in items)
+
+
+def _spill_texts(texts, max_len, max_ngrams, temp_dir):
+    """ Counts the texts into sorted runs of at most max_ngrams n-grams, returns the runs and the total count. """
+    runs = []
+    total = 0
+    counter = NgramCounter(max_len)
+    for text in texts:
+        counter.add(text)
+        if len(counter) >= max_ngrams:
+            runs.append(write_run(sorted(counter.items()), temp_dir))
+            total += counter.total
+            counter = NgramCounter(max_len)
+    if len(counter):
+        runs.append(write_run(sorted(counter.items()), temp_dir))
+        total += counter.total
+    return runs, total
+
+
+def file_shards(data_file, shards):
+    """ Splits a file into about equal byte ranges [start, end), each ends at a line end. """
+    size = os.path.getsize(data_file)
+    bounds = [0]
+    with open(data_file, 'rb') as f:
+        for i in range(1, shards):
+            pos = size * i // shards
+            if pos <= bounds[-1]:
+                continue
+            # move to the end of the line the range would split
+            f.seek(pos - 1)
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def shard_texts(data_file, start, end):
+    """ Yields the clean zh char texts of the lines in a byte range of a file, like text_iterator. """
+    with open(data_file, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            pos += len(line)
+            for text in line_texts(line.decode('utf-8')):
+                yield text
+
+
+def _count_shard(shard):
+    data_file, start, end, max_len = shard
+    counter = NgramCounter(max_len)
+    for text in shard_texts(data_file, start, end):
+        counter.add(text)
+    return counter
+
+
+def _spill_shard(shard):
+    data_file, start, end, max_len, max_ngrams, temp_dir = shard
+    return _spill_texts(shard_texts(data_file, start, end), max_len, max_ngrams, temp_dir)
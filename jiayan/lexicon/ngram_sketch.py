@@ -0,0 +1,386 @@
+import os
+from itertools import compress
+from math import e, exp
+
+import numpy as np
+
+from jiayan.lexicon.ngram_counter import file_shards, shard_texts
+from jiayan.lexicon.ngram_table import NgramTable, f_log_f
+from jiayan.utils import text_iterator
+
+"""
+Approximate char N-grams counting in a memory budget, for quick lexicon exploration of huge corpora.
+
+All the n-grams are counted in a Count-Min sketch, a depth x width array of counters, each n-gram adding 1 to one
+counter of each row chosen by a hash of the row, and the estimated freq of an n-gram is the min of its counters.
+With N n-grams counted, the estimate f' of an n-gram of freq f is never less than f, and
+
+    f' <= f + e / width * N    with probability at least 1 - exp(-depth).
+
+The n-grams are hashed in numpy: the texts are joined into an array of char codes, and the 64 bit keys of the n-grams
+of each length are rolled from the keys of the n-grams one char shorter, so there is no python loop over the n-grams.
+
+A lexicon is made in two passes over the corpus:
+    1. count all the n-grams in the sketch;
+    2. count exactly the candidates, the n-grams estimated at least some min estimate T times, which are all the
+       n-grams at least T times (their estimates are never less than their freqs) and their parts, and sum up the
+       neighbors of the candidates.
+
+The candidates are bounded by the memory too: T starts at 1, and whenever there would be more candidates than fit
+in the memory, T is raised, and the candidates estimated less are dropped, see CandidateSet. T only rises, so a
+candidate in the end has been one since its first occurrence, and its freq is exact. The words less frequent than
+the final T may be missed, and more memory counts more n-grams exactly, down to all of them.
+
+So the freqs and PMI of the words are exact, and only the entropies are approximate. The sum S of the freqs of the
+neighbors is exact, as each occurrence of a neighbor adds 1, and the entropy is log2(S) - sum(f * log2(f)) / S. A
+neighbor that is a candidate adds its exact f * log2(f) to the sum, but a rare neighbor adds log2(f') for each of
+its f occurrences, f * log2(f') in all, which is no less. So an entropy is never overestimated, and is underestimated
+by sum(f * log2(f' / f)) / S over the rare neighbors, an average of their log2(f' / f) weighted by f / S <= 1, which
+is at most log2(1 + e / width * N / f) for the rarest of them, with the probability above. The approximate lexicon
+is then a subset of the exact lexicon.
+
+The sketch is counted with conservative update, see CountMinSketch.add(), which keeps the bounds above, and the
+estimate of an n-gram is capped by the estimates of its parts, so in practice the errors are much smaller than the
+bounds, run benchmarks.bench_approx_lexicon() to compare a corpus with its exact lexicon in some memory budgets.
+
+The memory budget is shared by the sketch, depth * width * 8 bytes, and the candidates, about CANDIDATE_BYTES each,
+however many n-grams the corpus has, and the arrays of a batch of texts take about BATCH_CHARS * 200 bytes more.
+"""
+
+# the texts are hashed in batches of about this many chars
+BATCH_CHARS = 2 ** 18
+
+DEFAULT_DEPTH = 4
+
+# the share of the memory for the candidates, the rest is for the sketch
+CANDIDATE_SHARE = 0.5
+# about the bytes of a candidate, counted and then in the table of the lexicon
+CANDIDATE_BYTES = 400
+
+# the multiplier of the rolling hash, and of the seeds of the sketch rows
+HASH_BASE = np.uint64(0x100000001b3)
+SEED_BASE = np.uint64(0x9e3779b97f4a7c15)
+
+
+def mix(keys):
+    """ The splitmix64 finalizer, spreads all the bits of the 64 bit keys. """
+    keys = keys ^ (keys >> np.uint64(30))
+    keys *= np.uint64(0xbf58476d1ce4e5b9)
+    keys ^= keys >> np.uint64(27)
+    keys *= np.uint64(0x94d049bb133111eb)
+    keys ^= keys >> np.uint64(31)
+    return keys
+
+
+def ngram_keys(texts, max_len):
+    """ Joins the texts, and hashes all their 1 ... max_len grams. Returns the joined text, and for each length n,
+        the keys of the n-grams starting at each position of the joined text, and the mask of those not crossing the
+        end of a text, both indexed by n, so joined[i:i + n] is the n-gram of keys[n][i].
+    """
+    joined = ''.join(texts)
+    codes = np.frombuffer(joined.encode('utf-32-le'), np.uint32).astype(np.uint64)
+    lengths = np.fromiter(map(len, texts), np.int64, len(texts))
+    ends = np.repeat(np.cumsum(lengths), lengths)
+    positions = np.arange(len(codes))
+
+    keys = [None]
+    valid = [None]
+    hashes = np.zeros(len(codes), np.uint64)
+    for n in range(1, max_len + 1):
+        size = max(len(codes) - n + 1, 0)
+        hashes = hashes[:size] * HASH_BASE + codes[n - 1:]
+        # the length is mixed in, so the n-grams of different lengths never share a rolling hash
+        keys.append(mix(hashes + np.uint64(n)))
+        valid.append(positions[:size] + n <= ends[:size])
+    return joined, keys, valid
+
+
+def text_batches(texts, batch_chars=BATCH_CHARS):
+    """ Groups the texts into lists of about batch_chars chars. """
+    batch = []
+    chars = 0
+    for text in texts:
+        batch.append(text)
+        chars += len(text)
+        if chars >= batch_chars:
+            yield batch
+            batch = []
+            chars = 0
+    if batch:
+        yield batch
+
+
+class CountMinSketch:
+
+    def __init__(self, width, depth=DEFAULT_DEPTH):
+        """ The width is rounded up to a power of 2, so the counter of a key in a row is the top bits of its hash.
+        """
+        bits = max(int(width - 1).bit_length(), 1)
+        self.width = 2 ** bits
+        self.depth = depth
+        self.shift = np.uint64(64 - bits)
+        self.seeds = mix(np.arange(1, depth + 1, dtype=np.uint64) * SEED_BASE)
+        self.counts = np.zeros((depth, self.width), np.int64)
+
+    @classmethod
+    def from_memory(cls, memory, depth=DEFAULT_DEPTH):
+        """ The widest sketch of at most memory bytes. """
+        width = max(memory // (depth * 8), 2)
+        return cls(2 ** (width.bit_length() - 1), depth)
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes
+
+    def indexes(self, keys):
+        """ The index of the counter of each key in each row. """
+        return [(mix(keys ^ seed) >> self.shift).astype(np.intp) for seed in self.seeds]
+
+    def add(self, keys):
+        """ Counts the keys with conservative update: the counters of a key are only raised to its estimate plus its
+            count, instead of all added its count, which still never underestimates, and overestimates much less.
+        """
+        keys, counts = np.unique(keys, return_counts=True)
+        indexes = self.indexes(keys)
+        estimates = np.minimum.reduce([row[index] for row, index in zip(self.counts, indexes)]) + counts
+        for row, index in zip(self.counts, indexes):
+            np.maximum.at(row, index, estimates)
+
+    def estimate(self, keys):
+        return np.minimum.reduce([row[index] for row, index in zip(self.counts, self.indexes(keys))])
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    def error_bound(self, total):
+        """ The bound of the overestimate of each freq, and the probability the bound holds. """
+        return e / self.width * total, 1 - exp(-self.depth)
+
+
+class KeyIndex:
+    """ Gives ids to 64 bit keys, in the order they are added, and looks them up in a sorted array. """
+
+    def __init__(self):
+        self.keys = np.zeros(0, np.uint64)
+        self.ids = np.zeros(0, np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keys):
+        """ The ids of the keys, -1 for those not added. """
+        if not len(self.keys):
+            return np.full(len(keys), -1, np.int64)
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[positions] == keys, self.ids[positions], -1)
+
+    def add(self, keys):
+        """ Adds unique new keys, with ids in the order given, merged into the sorted array at once. """
+        order = np.argsort(keys)
+        positions = np.searchsorted(self.keys, keys[order])
+        self.ids = np.insert(self.ids, positions, len(self) + order)
+        self.keys = np.insert(self.keys, positions, keys[order])
+
+    def keep(self, kept):
+        """ Keeps the keys of the ids in the mask kept, and renumbers the ids in order. """
+        mask = kept[self.ids]
+        self.keys = self.keys[mask]
+        self.ids = (np.cumsum(kept) - 1)[self.ids[mask]]
+
+
+class CandidateSet:
+    """ The n-grams counted exactly in the second pass of SketchNgramCounter, with their freqs and the sums of their
+        neighbors, at most max_size of them. The candidates are the n-grams estimated at least min_estimate times,
+        which starts at 1, and is raised whenever there would be more candidates, dropping the least estimated.
+    """
+
+    # by id: the estimates, the exact freqs, the ids of the n-grams without their last and first chars, -1 if not
+    # candidates, and the sums of the neighbors, of which the candidates get f * log2(f) in the end
+    COLUMNS = (('estimates', np.int64), ('freqs', np.int64), ('prefixes', np.int64), ('suffixes', np.int64),
+               ('r_sums', np.float64), ('r_f_log_f_sums', np.float64),
+               ('l_sums', np.float64), ('l_f_log_f_sums', np.float64))
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.min_estimate = 1
+        self.index = KeyIndex()
+        self.ngrams = []
+        # the columns grow geometrically, up to max_size
+        self.columns = {name: np.zeros(0, dtype) for name, dtype in self.COLUMNS}
+
+    def __len__(self):
+        return len(self.ngrams)
+
+    def add(self, joined, keys, estimates, masks):
+        """ Adds the new candidates of a batch, the n-grams in masks, see SketchNgramCounter.table(). If there would be
+            more than max_size candidates, raises min_estimate first, and narrows the masks to it.
+        """
+        new = [None]
+        for n in range(1, len(keys)):
+            positions = np.flatnonzero(masks[n])
+            positions = positions[self.index.lookup(keys[n][positions]) < 0]
+            _, first = np.unique(keys[n][positions], return_index=True)
+            new.append(positions[first])
+
+        if len(self) + sum(len(positions) for positions in new[1:]) > self.max_size:
+            self.raise_min_estimate(np.concatenate([self.columns['estimates'][:len(self)]] +
+                                                   [estimates[n][new[n]] for n in range(1, len(keys))]))
+            for n in range(1, len(keys)):
+                masks[n] &= estimates[n] >= self.min_estimate
+                new[n] = new[n][estimates[n][new[n]] >= self.min_estimate]
+
+        start = len(self)
+        self.index.add(np.concatenate([keys[n][new[n]] for n in range(1, len(keys))]))
+        for n in range(1, len(keys)):
+            self.ngrams.extend(joined[i:i + n] for i in new[n].tolist())
+        size = len(self)
+        for name in self.columns:
+            column = self.columns[name]
+            if len(column) < size:
+                grown = np.zeros(min(max(size, 2 * len(column)), self.max_size), column.dtype)
+                grown[:start] = column[:start]
+                self.columns[name] = column = grown
+            column[start:size] = 0
+        self.columns['estimates'][start:size] = np.concatenate([estimates[n][new[n]] for n in range(1, len(keys))])
+        # the parts of the new n-grams are estimated no less, so they are candidates, new or not
+        self.columns['prefixes'][start:size] = np.concatenate(
+            [np.full(len(new[1]), -1)] + [self.index.lookup(keys[n - 1][new[n]]) for n in range(2, len(keys))])
+        self.columns['suffixes'][start:size] = np.concatenate(
+            [np.full(len(new[1]), -1)] + [self.index.lookup(keys[n - 1][new[n] + 1]) for n in range(2, len(keys))])
+
+    def count(self, keys, valid, estimates, masks):
+        """ Counts the candidates of a batch, and sums up the neighbors of the candidates. """
+        size = len(self)
+        ids = [None]
+        for n in range(1, len(keys)):
+            positions = np.flatnonzero(masks[n])
+            n_ids = np.full(len(keys[n]), -1, np.int64)
+            n_ids[positions] = self.index.lookup(keys[n][positions])
+            ids.append(n_ids)
+            self.columns['freqs'][:size] += np.bincount(n_ids[positions], minlength=size)
+
+        for n in range(2, len(keys)):
+            positions = np.flatnonzero(valid[n])
+            # sum(f * log2(f)) of the neighbors is sum(log2(f)) of their occurrences
+            log_freqs = np.where(masks[n][positions], 0, np.log2(estimates[n][positions]))
+            for parents, sums, f_log_f_sums in ((ids[n - 1][positions], 'r_sums', 'r_f_log_f_sums'),
+                                                (ids[n - 1][positions + 1], 'l_sums', 'l_f_log_f_sums')):
+                has_parent = parents >= 0
+                self.columns[sums][:size] += np.bincount(parents[has_parent], minlength=size)
+                self.columns[f_log_f_sums][:size] += np.bincount(parents[has_parent], log_freqs[has_parent], size)
+
+    def raise_min_estimate(self, estimates):
+        """ Raises min_estimate so that at most max_size of the estimates reach it, and drops the candidates below it.
+            The occurrences of a dropped candidate counted so far are summed up as the ones of a neighbor that is not
+            a candidate, as its occurrences to come.
+        """
+        kth = len(estimates) - self.max_size - 1
+        self.min_estimate = max(self.min_estimate, int(np.partition(estimates, kth)[kth]) + 1)
+        size = len(self)
+        dropped = self.columns['estimates'][:size] < self.min_estimate
+        if not dropped.any():
+            return
+
+        ids = np.flatnonzero(dropped)
+        log_freqs = self.columns['freqs'][ids] * np.log2(self.columns['estimates'][ids])
+        for parents, f_log_f_sums in (('prefixes', 'r_f_log_f_sums'), ('suffixes', 'l_f_log_f_sums')):
+            parent_ids = self.columns[parents][ids]
+            has_parent = parent_ids >= 0
+            np.add.at(self.columns[f_log_f_sums], parent_ids[has_parent], log_freqs[has_parent])
+
+        kept = ~dropped
+        new_ids = np.cumsum(kept) - 1
+        for name in self.columns:
+            column = self.columns[name][:size][kept]
+            if name in ('prefixes', 'suffixes'):
+                # the parts of a kept candidate are estimated no less, so they are kept too
+                column = np.where(column >= 0, new_ids[column], -1)
+            self.columns[name] = column
+        self.index.keep(kept)
+        self.ngrams = list(compress(self.ngrams, kept.tolist()))
+
+    def table(self, total):
+        """ The table of the candidates, with the exact f * log2(f) of the candidate neighbors added to the sums. """
+        size = len(self)
+        columns = {name: np.array(column[:size]) for name, column in self.columns.items()}
+        table = NgramTable(self.ngrams, columns['freqs'], total, columns['prefixes'], columns['suffixes'])
+        for name in ('r_sums', 'r_f_log_f_sums', 'l_sums', 'l_f_log_f_sums'):
+            setattr(table, name, columns[name])
+        table._add_to_sums(table.prefixes, table.suffixes, np.zeros(size), f_log_f(table.freqs))
+        return table
+
+
+class SketchNgramCounter:
+    """ Counts n-grams approximately in about memory bytes, a Count-Min sketch and the candidates counted exactly in
+        a second pass over the counted files, see table().
+    """
+
+    def __init__(self, max_len, memory, depth=DEFAULT_DEPTH):
+        self.max_len = max_len
+        self.memory = memory
+        self.max_candidates = max(int(memory * CANDIDATE_SHARE) // CANDIDATE_BYTES, 1)
+        self.sketch = CountMinSketch.from_memory(memory - self.max_candidates * CANDIDATE_BYTES, depth)
+        self.total = 0
+        self.data_files = []
+        # the min estimate of the candidates of the last table
+        self.min_estimate = 1
+
+    def add_texts(self, texts):
+        """ Counts all the n-grams of the texts in the sketch. """
+        for batch in text_batches(texts):
+            _, keys, valid = ngram_keys(batch, self.max_len)
+            for n in range(1, self.max_len + 1):
+                n_keys = keys[n][valid[n]]
+                self.sketch.add(n_keys)
+                self.total += len(n_keys)
+
+    def count_file(self, data_file, workers=1):
+        """ Counts the n-grams of a corpus file in the sketch, by shards in a pool of workers if workers is not 1,
+            each counted in a sketch of its own, and the sketches are summed up.
+        """
+        if workers == 1:
+            self.add_texts(text_iterator(data_file))
+        else:
+            from multiprocessing import Pool
+
+            workers = workers or os.cpu_count()
+            shards = [(data_file, start, end, self.max_len, self.memory, self.sketch.depth)
+                      for start, end in file_shards(data_file, workers)]
+            with Pool(workers) as pool:
+                for counter in pool.imap(_sketch_shard, shards):
+                    self.sketch.merge(counter.sketch)
+                    self.total += counter.total
+        self.data_files.append(data_file)
+
+    def error_bound(self):
+        return self.sketch.error_bound(self.total)
+
+    def table(self):
+        """ Counts the counted files again, into the table of the candidates, the n-grams most estimated, at most
+            max_candidates of them, with their exact freqs and neighbor sums. The words at least min_estimate times
+            are all in the table.
+        """
+        candidates = CandidateSet(self.max_candidates)
+        for data_file in self.data_files:
+            for batch in text_batches(text_iterator(data_file)):
+                joined, keys, valid = ngram_keys(batch, self.max_len)
+                # an n-gram is no more frequent than its parts, so its estimate is capped by theirs
+                estimates = [None, self.sketch.estimate(keys[1])]
+                for n in range(2, self.max_len + 1):
+                    estimates.append(np.minimum.reduce([self.sketch.estimate(keys[n]),
+                                                        estimates[n - 1][:-1], estimates[n - 1][1:]]))
+
+                masks = [None] + [valid[n] & (estimates[n] >= candidates.min_estimate)
+                                  for n in range(1, self.max_len + 1)]
+                candidates.add(joined, keys, estimates, masks)
+                candidates.count(keys, valid, estimates, masks)
+
+        self.min_estimate = candidates.min_estimate
+        return candidates.table(self.total)
+
+
+def _sketch_shard(shard):
+    data_file, start, end, max_len, memory, depth = shard
+    counter = SketchNgramCounter(max_len, memory, depth)
+    counter.add_texts(shard_texts(data_file, start, end))
+    return counter
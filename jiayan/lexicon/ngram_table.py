@@ -0,0 +1,218 @@
+import os
+import struct
+import tempfile
+from itertools import repeat
+from operator import itemgetter
+
+import numpy as np
+
+"""
+A table of char N-grams to compute PMI and entropies with, in arrays.
+
+Each n-gram gets an id of its position in the table, and the table keeps in arrays over the ids their freqs, the ids of
+the n-grams without their last and first chars (the n-grams they are right and left neighbors of), and the sums of
+freqs f and f * log2(f) of their right and left neighbors, which are all that is needed to compute the entropies.
+
+A table of all the counted n-grams is the raw counts of a corpus, it could be saved to a file and loaded back, and
+the counts of new texts could be merged into it: the neighbor sums are only updated by the changes of the merged
+n-grams, so only the n-grams merged and the n-grams they are neighbors of need their entropies computed again.
+"""
+
+without_last = itemgetter(slice(None, -1))
+without_first = itemgetter(slice(1, None))
+
+# the table file header: magic, format version, total count, number of n-grams, bytes of the n-grams text
+TABLE_HEADER = struct.Struct('<8sIqqq')
+TABLE_MAGIC = b'JIAYANNG'
+TABLE_VERSION = 1
+
+
+def f_log_f(freqs):
+    """ f * log2(f) of each freq f, 0 if f is 0. """
+    freqs = freqs.astype(np.float64)
+    result = np.zeros(len(freqs))
+    nonzero = freqs > 0
+    result[nonzero] = freqs[nonzero] * np.log2(freqs[nonzero])
+    return result
+
+
+def entropies(sums, f_log_f_sums):
+    """ The entropy - sum(f / S * log2(f / S)), S = sum(f), is log2(S) - sum(f * log2(f)) / S, 0 if no neighbors. """
+    result = np.zeros(len(sums))
+    has_neighbors = sums > 0
+    sums = sums[has_neighbors]
+    result[has_neighbors] = np.log2(sums) - f_log_f_sums[has_neighbors] / sums
+    # a single neighbor may get a tiny negative rounding error
+    return np.maximum(result, 0.0)
+
+
+class NgramTable:
+
+    def __init__(self, ngrams, freqs, total, prefixes=None, suffixes=None):
+        """ The parts of the n-grams without their last and first chars should be in the n-grams, or they are not
+            able to get PMI. The ids of the parts are looked up if not given.
+        """
+        self.ngrams = list(ngrams)
+        self.index = {ngram: i for i, ngram in enumerate(self.ngrams)}
+        self.freqs = np.array(freqs, dtype=np.int64)
+        self.total = total
+        self.lengths = np.fromiter(map(len, self.ngrams), np.int64, len(self.ngrams))
+        self.prefixes = self.lookup(map(without_last, self.ngrams)) if prefixes is None else prefixes
+        self.suffixes = self.lookup(map(without_first, self.ngrams)) if suffixes is None else suffixes
+
+        size = len(self.ngrams)
+        self.r_sums, self.r_f_log_f_sums = np.zeros(size), np.zeros(size)
+        self.l_sums, self.l_f_log_f_sums = np.zeros(size), np.zeros(size)
+
+    def __len__(self):
+        return len(self.ngrams)
+
+    @classmethod
+    def from_counter(cls, counter, batch_size):
+        """ Makes a table of all the n-grams of a counter, with their neighbor sums. """
+        ngrams = []
+        freqs = []
+        for batch_ngrams, batch_freqs in counter.batches(batch_size):
+            ngrams.extend(batch_ngrams)
+            freqs.append(batch_freqs)
+        table = cls(ngrams, np.concatenate(freqs) if freqs else [], counter.total)
+        table.sum_neighbors()
+        return table
+
+    def lookup(self, ngrams):
+        """ The ids of the n-grams, -1 for those not in the table, looked up without a python loop. """
+        return np.fromiter(map(self.index.get, ngrams, repeat(-1)), np.int64)
+
+    def sum_neighbors(self):
+        """ Sums up the neighbor freqs of all the n-grams, from the n-grams in the table. """
+        size = len(self)
+        freqs = self.freqs.astype(np.float64)
+        f_log_fs = f_log_f(self.freqs)
+        for parents, sums, f_log_f_sums in ((self.prefixes, self.r_sums, self.r_f_log_f_sums),
+                                            (self.suffixes, self.l_sums, self.l_f_log_f_sums)):
+            neighbors = parents >= 0
+            sums[:] = np.bincount(parents[neighbors], weights=freqs[neighbors], minlength=size)
+            f_log_f_sums[:] = np.bincount(parents[neighbors], weights=f_log_fs[neighbors], minlength=size)
+
+    def add_neighbors(self, ngrams, freqs):
+        """ Adds the freqs of the n-grams, in the table or not, to the neighbor sums of the n-grams in the table
+            they are neighbors of.
+        """
+        self._add_to_sums(self.lookup(map(without_last, ngrams)), self.lookup(map(without_first, ngrams)),
+                          freqs.astype(np.float64), f_log_f(freqs))
+
+    def _add_to_sums(self, r_ids, l_ids, freqs, f_log_fs):
+        for ids, sums, f_log_f_sums in ((r_ids, self.r_sums, self.r_f_log_f_sums),
+                                        (l_ids, self.l_sums, self.l_f_log_f_sums)):
+            neighbors = ids >= 0
+            np.add.at(sums, ids[neighbors], freqs[neighbors])
+            np.add.at(f_log_f_sums, ids[neighbors], f_log_fs[neighbors])
+
+    def extend(self, ngrams):
+        """ Adds new n-grams with 0 freqs, returns their ids. """
+        start = len(self)
+        self.ngrams.extend(ngrams)
+        for i, ngram in enumerate(ngrams, start):
+            self.index[ngram] = i
+        ids = np.arange(start, len(self))
+
+        zeros = np.zeros(len(ngrams))
+        self.freqs = np.concatenate([self.freqs, zeros.astype(np.int64)])
+        self.lengths = np.concatenate([self.lengths, np.fromiter(map(len, ngrams), np.int64, len(ngrams))])
+        # the parts of the new n-grams may be new too, so look them up after all are indexed
+        self.prefixes = np.concatenate([self.prefixes, self.lookup(map(without_last, ngrams))])
+        self.suffixes = np.concatenate([self.suffixes, self.lookup(map(without_first, ngrams))])
+        for name in ('r_sums', 'r_f_log_f_sums', 'l_sums', 'l_f_log_f_sums'):
+            setattr(self, name, np.concatenate([getattr(self, name), zeros]))
+        return ids
+
+    def update(self, counter):
+        """ Merges the counts of an NgramCounter, returns the ids of the n-grams whose freqs or neighbors changed.
+        """
+        ngrams = list(counter.counts)
+        deltas = np.fromiter(counter.counts.values(), np.int64, len(ngrams))
+        ids = self.lookup(ngrams)
+        new = np.flatnonzero(ids < 0)
+        if len(new):
+            ids[new] = self.extend([ngrams[i] for i in new.tolist()])
+
+        old_freqs = self.freqs[ids]
+        self.freqs[ids] += deltas
+        self.total += counter.total
+
+        # the changes of the merged n-grams are the changes of the neighbor sums
+        self._add_to_sums(self.prefixes[ids], self.suffixes[ids],
+                          deltas.astype(np.float64), f_log_f(self.freqs[ids]) - f_log_f(old_freqs))
+
+        changed = np.concatenate([ids, self.prefixes[ids], self.suffixes[ids]])
+        return np.unique(changed[changed >= 0])
+
+    def pmis(self, ids, single_char_pmi):
+        """ The PMI of an n-gram is the min of freq(ngram) * total / (freq(left) * freq(right)) of all the 2 part
+            splits, where the left parts are found by walking the ids of the n-grams without their last chars, and
+            the right parts by the ids of the n-grams without their first chars.
+        """
+        freqs = self.freqs.astype(np.float64)
+        lengths = self.lengths[ids]
+        max_len = int(lengths.max()) if len(ids) else 0
+
+        # prefixes[j] / suffixes[j] are the ids of the n-grams without their last / first j chars
+        prefixes = [ids]
+        suffixes = [ids]
+        for _ in range(1, max_len):
+            prefixes.append(np.where(prefixes[-1] >= 0, self.prefixes[prefixes[-1]], -1))
+            suffixes.append(np.where(suffixes[-1] >= 0, self.suffixes[suffixes[-1]], -1))
+        prefixes = np.array(prefixes)
+
+        pmis = np.full(len(ids), np.inf)
+        for k in range(1, max_len):
+            # split the n-grams longer than k chars into the first k chars and the rest
+            split = np.flatnonzero(lengths > k)
+            lefts = prefixes[lengths[split] - k, split]
+            rights = suffixes[k][split]
+            mutuals = freqs[ids[split]] * self.total / (freqs[lefts] * freqs[rights])
+            pmis[split] = np.minimum(pmis[split], mutuals)
+        pmis[lengths == 1] = single_char_pmi
+        return pmis
+
+    def entropies(self, ids):
+        """ The right and left entropies of the n-grams. """
+        return (entropies(self.r_sums[ids], self.r_f_log_f_sums[ids]),
+                entropies(self.l_sums[ids], self.l_f_log_f_sums[ids]))
+
+    def save(self, table_f):
+        """ Saves the n-grams, their freqs and the ids of their parts, the neighbor sums are summed up again when
+            loaded. The file is written to a temp file first, then renamed, so it is never left half written.
+        """
+        text = '\n'.join(self.ngrams).encode('utf-8')
+        fd, temp_f = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(table_f)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(TABLE_HEADER.pack(TABLE_MAGIC, TABLE_VERSION, self.total, len(self), len(text)))
+                f.write(text)
+                for arr in (self.freqs, self.prefixes, self.suffixes):
+                    f.write(arr.astype('<i8').tobytes())
+            os.replace(temp_f, table_f)
+        except BaseException:
+            os.remove(temp_f)
+            raise
+
+    @classmethod
+    def load(cls, table_f):
+        with open(table_f, 'rb') as f:
+            header = f.read(TABLE_HEADER.size)
+            if len(header) < TABLE_HEADER.size:
+                raise ValueError('Not an n-gram table file: {}'.format(table_f))
+            magic, version, total, size, text_size = TABLE_HEADER.unpack(header)
+            if magic != TABLE_MAGIC:
+                raise ValueError('Not an n-gram table file: {}'.format(table_f))
+            if version != TABLE_VERSION:
+                raise ValueError('Unsupported n-gram table version {}: {}'.format(version, table_f))
+
+            text = f.read(text_size).decode('utf-8')
+            ngrams = text.split('\n') if size else []
+            freqs, prefixes, suffixes = [np.frombuffer(f.read(8 * size), '<i8').astype(np.int64) for _ in range(3)]
+
+        table = cls(ngrams, freqs, total, prefixes, suffixes)
+        table.sum_neighbors()
+        return table
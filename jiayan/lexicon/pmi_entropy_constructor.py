@@ -1,7 +1,12 @@
-from math import log2
+import heapq
 import time
+
+import numpy as np
+
 from jiayan.globals import stopchars
-from jiayan.utils import text_iterator
+from jiayan.lexicon.ngram_counter import NgramCounter, ExternalNgramCounter
+from jiayan.lexicon.ngram_sketch import SketchNgramCounter
+from jiayan.lexicon.ngram_table import NgramTable
 
 """
 A precise way to discover new words in sentence corpus, consider PMI and entropy.
@@ -10,35 +15,8 @@ A precise way to discover new words in sentence corpus, consider PMI and entropy
 2. Right and left entropy are used to evaluate how independent the word is in various contexts.
 """
 
-
-class Trie:
-
-    class TrieNode:
-        def __init__(self):
-            self.freq = 0
-            self.pmi = 0
-            self.r_entropy = 0
-            self.l_entropy = 0
-            self.children = {}
-
-    def __init__(self):
-        self.root = self.TrieNode()
-
-    def add(self, word):
-        node = self.root
-        for char in word:
-            if char not in node.children:
-                node.children[char] = self.TrieNode()
-            node = node.children[char]
-        node.freq += 1
-
-    def find(self, word):
-        node = self.root
-        for char in word:
-            if char not in node.children:
-                return None
-            node = node.children[char]
-        return node
+# the counted n-grams are processed in batches of this size, so a stream of them never needs to fit in memory
+BATCH_SIZE = 2 ** 16
 
 
 class PMIEntropyLexiconConstructor:
@@ -46,120 +24,218 @@ class PMIEntropyLexiconConstructor:
     MIN_WORD_LEN = 1
     MAX_WORD_LEN = 4
 
-    # TODO: Different PMI and Entropy thresholds for different lengths
     MIN_WORD_FREQ = 10
     MIN_PMI = 80
     MIN_ENTROPY = 2
 
-    def __init__(self):
-        self.trie = Trie()
-        self.r_trie = Trie()
-        self.total = 0
+    # the thresholds of some word lengths different from the ones above, e.g. {1: 20, 4: 5}
+    MIN_WORD_FREQS = {}
+    MIN_PMIS = {}
+    MIN_ENTROPIES = {}
+
+    def __init__(self, max_ngrams=None, temp_dir=None, sketch_memory=None):
+        """ If max_ngrams is given, the n-grams are counted out of core, at most max_ngrams of them in memory at a
+            time, and spilled to temp files in temp_dir, see ExternalNgramCounter.
+            If sketch_memory is given, the n-grams are counted approximately in about this many bytes, a Count-Min
+            sketch, and the candidate words counted exactly when the counted files are read again, see
+            SketchNgramCounter.
+        """
+        if sketch_memory:
+            self.counter = SketchNgramCounter(self.MAX_WORD_LEN + 1, sketch_memory)
+        elif max_ngrams:
+            self.counter = ExternalNgramCounter(self.MAX_WORD_LEN + 1, max_ngrams, temp_dir)
+        else:
+            self.counter = NgramCounter(self.MAX_WORD_LEN + 1)
 
-    def construct_lexicon(self, data_file):
-        self.build_trie_trees(data_file)
+        # the table of the candidate words, or of all the n-grams once saved or updated,
+        # and the arrays of their entropies
+        self.table = None
+        self.r_entropies = None
+        self.l_entropies = None
+
+    @property
+    def total(self):
+        return self.counter.total if self.counter is not None else self.table.total
+
+    def construct_lexicon(self, data_file, workers=1):
+        self.count_ngrams(data_file, workers)
         self.compute()
         lexicon = self.filter()
         return lexicon
 
-    def build_trie_trees(self, data_file):
-        """ Counts frequency of segments of data, also records their left and right char sets.
+    def count_ngrams(self, data_file, workers=1):
+        """ Counts frequency of segments of data, the segments one char longer are their left and right contexts.
+            The file is counted by shards in a pool of workers if workers is not 1, all cpu cores if None.
         """
-        max_seg_len = self.MAX_WORD_LEN + 1
-
         start = time.time()
-        for text in text_iterator(data_file):
-            length = len(text)
-            for i in range(length):
-                for j in range(1, min(length - i + 1, max_seg_len + 1)):
-                    seg = text[i: i + j]
-                    self.trie.add(seg)
-
-                    r_seg = seg[::-1]
-                    self.r_trie.add(r_seg)
-
-                    self.total += 1
+        self.counter.count_file(data_file, workers)
         end = time.time()
 
-        print('Trie building time:', end - start)
+        print('N-grams counting time:', end - start)
+
+    # kept for the scripts calling it by its old name
+    build_trie_trees = count_ngrams
 
     def compute(self):
+        """ Computes PMI and entropies of the words frequent enough to be in the lexicon, in two passes over the
+            counted n-grams, so the n-grams could be a stream.
+        """
         start = time.time()
-        node = self.trie.root
-        word = ''
-        self.compute_help(node, word)
+        # the parts of a word are at least as frequent as the word, so they are also candidates,
+        # whatever the freq thresholds of their lengths are
+        min_freq = min([self.MIN_WORD_FREQ] + list(self.MIN_WORD_FREQS.values()))
+        if isinstance(self.counter, SketchNgramCounter):
+            error, prob = self.counter.error_bound()
+            print('Sketch freq overestimate: <= {:.1f} with probability {:.3f}'.format(error, prob))
+            self.table = self.counter.table()
+            print('Sketch candidates: {}, estimated at least {} times'.format(len(self.table), self.counter.min_estimate))
+            if self.counter.min_estimate > min_freq:
+                print('The words less frequent than {} may be missed in this memory'.format(self.counter.min_estimate))
+            self.compute_scores()
+            end = time.time()
+            print('Computation time:', end - start)
+            return
+
+        words = []
+        freqs = []
+        for segs, seg_freqs in self.counter.batches(BATCH_SIZE):
+            for i in np.flatnonzero(seg_freqs >= min_freq).tolist():
+                if len(segs[i]) <= self.MAX_WORD_LEN:
+                    words.append(segs[i])
+                    freqs.append(seg_freqs[i])
+
+        self.table = NgramTable(words, freqs, self.total)
+        for segs, seg_freqs in self.counter.batches(BATCH_SIZE):
+            self.table.add_neighbors(segs, seg_freqs)
+        self.compute_scores()
         end = time.time()
         print('Computation time:', end - start)
 
-    def compute_help(self, node, word):
-        if node.children:
-            for char, child in node.children.items():
-                word += char
-                if len(word) <= self.MAX_WORD_LEN:
-                    self.calculate_pmi(child, word)
-                    self.calculate_rl_entropy(child, word)
-                    self.compute_help(child, word)
-                word = word[:-1]
-
-    def calculate_pmi(self, node, word):
-        length = len(word)
-        if length == 1:
-            node.pmi = self.MIN_PMI
+    def compute_scores(self, changed=None):
+        """ Computes entropies of the changed n-grams in the table, all if None. PMI is computed when filtering, for it
+            changes with the total count, and is only needed for the words passing the other thresholds.
+        """
+        table = self.table
+        if changed is None or self.r_entropies is None:
+            self.r_entropies, self.l_entropies = table.entropies(slice(None))
         else:
-            constant = node.freq * self.total
-            mutuals = (constant / (self.trie.find(word[:i + 1]).freq * self.trie.find(word[i + 1:]).freq)
-                       for i in range(length - 1))
-            node.pmi = min(mutuals)
-
-    def calculate_rl_entropy(self, node, word):
-        # right entropy
-        if node.children:
-            node.r_entropy = self.calculate_entropy(node)
-
-        # left entropy
-        r_word = word[::-1]
-        r_node = self.r_trie.find(r_word)
-        if r_node.children:
-            node.l_entropy = self.calculate_entropy(r_node)
-
-    def calculate_entropy(self, node):
-        freqs = [child.freq for child in node.children.values()]
-        sum_freqs = sum(freqs)
-        entropy = sum([- (x / sum_freqs) * log2(x / sum_freqs) for x in freqs])
-        return entropy
-
-    def filter(self):
-        """ Filters the PMI and entropy calculation result dict, removes words that do not
-            reach the thresholds.
+            new = len(table) - len(self.r_entropies)
+            self.r_entropies = np.concatenate([self.r_entropies, np.zeros(new)])
+            self.l_entropies = np.concatenate([self.l_entropies, np.zeros(new)])
+            self.r_entropies[changed], self.l_entropies[changed] = table.entropies(changed)
+
+    def full_table(self):
+        """ Moves all the counted n-grams into the table, to be saved or updated. """
+        if isinstance(self.counter, SketchNgramCounter):
+            raise ValueError('Approximate counts are not able to be saved or updated')
+        if self.counter is not None:
+            start = time.time()
+            self.table = NgramTable.from_counter(self.counter, BATCH_SIZE)
+            if isinstance(self.counter, ExternalNgramCounter):
+                self.counter.close()
+            self.counter = None
+            self.compute_scores()
+            end = time.time()
+            print('N-grams table building time:', end - start)
+        return self.table
+
+    def save_counts(self, counts_f):
+        """ Saves the raw counts of all the n-grams counted, to update the lexicon with new texts later.
+        """
+        self.full_table().save(counts_f)
+
+    @classmethod
+    def load_counts(cls, counts_f):
+        constructor = cls()
+        constructor.counter = None
+        constructor.table = NgramTable.load(counts_f)
+        constructor.compute_scores()
+        return constructor
+
+    def update_lexicon(self, data_file, workers=1):
+        """ Merges the counts of a new corpus file, and filters the lexicon of all. """
+        self.merge_counts(data_file, workers)
+        return self.filter()
+
+    def merge_counts(self, data_file, workers=1):
+        """ Counts a new corpus file, merges the counts into the counts so far, computes the entropies again only for
+            the words whose neighbors changed.
+        """
+        table = self.full_table()
+        start = time.time()
+        counter = NgramCounter(self.MAX_WORD_LEN + 1)
+        counter.count_file(data_file, workers)
+        changed = table.update(counter)
+        self.compute_scores(changed)
+        end = time.time()
+        print('N-grams merging time:', end - start)
+
+    def length_thresholds(self, thresholds, default):
+        """ The array of the thresholds of all the word lengths, indexed by length. """
+        return np.array([thresholds.get(length, default) for length in range(self.MAX_WORD_LEN + 1)])
+
+    def iter_words(self, top_k=None):
+        """ Yields (word, [freq, PMI, right entropy, left entropy]) of the words reaching the thresholds of their
+            lengths, by length, then by freq, PMI and entropies, high to low. If top_k is given, only the top_k words
+            of each length are kept in a bounded heap, instead of sorting all the words.
             TODO: test use max of r/l entropy to filter.
         """
+        table = self.table
+        ids = np.flatnonzero((table.lengths >= self.MIN_WORD_LEN) & (table.lengths <= self.MAX_WORD_LEN))
+        lengths = table.lengths[ids]
+        min_entropies = self.length_thresholds(self.MIN_ENTROPIES, self.MIN_ENTROPY)[lengths]
+        valid = (table.freqs[ids] >= self.length_thresholds(self.MIN_WORD_FREQS, self.MIN_WORD_FREQ)[lengths]) \
+            & (self.r_entropies[ids] >= min_entropies) \
+            & (self.l_entropies[ids] >= min_entropies)
+        ids, lengths = ids[valid], lengths[valid]
+
+        # the PMI of a single char is set as the threshold
+        min_pmis = self.length_thresholds(self.MIN_PMIS, self.MIN_PMI)
+        pmis = table.pmis(ids, min_pmis[1])
+        valid = pmis >= min_pmis[lengths]
+        ids, lengths, pmis = ids[valid], lengths[valid], pmis[valid]
+
+        for length in range(self.MIN_WORD_LEN, self.MAX_WORD_LEN + 1):
+            selected = lengths == length
+            length_ids = ids[selected]
+            if length == 1:
+                length_pmis = [self.MIN_PMIS.get(1, self.MIN_PMI)] * len(length_ids)
+            else:
+                length_pmis = pmis[selected].tolist()
+            rows = ((table.ngrams[i], [freq, pmi, r_entropy, l_entropy])
+                    for i, freq, pmi, r_entropy, l_entropy in zip(
+                        length_ids.tolist(), table.freqs[length_ids].tolist(), length_pmis,
+                        self.r_entropies[length_ids].tolist(), self.l_entropies[length_ids].tolist())
+                    if not self.has_stopword(table.ngrams[i]))
+            if top_k is None:
+                rows = sorted(rows, key=self.rank)
+            else:
+                rows = heapq.nsmallest(top_k, rows, key=self.rank)
+            for row in rows:
+                yield row
+
+    @staticmethod
+    def rank(row):
+        word, (freq, pmi, r_entropy, l_entropy) = row
+        return -freq, -pmi, -r_entropy, -l_entropy, word
+
+    def filter(self, top_k=None):
+        """ Filters the PMI and entropy calculation results, removes words that do not
+            reach the thresholds.
+        """
         start = time.time()
-        node = self.trie.root
-        word = ''
-        word_dict = {}
-        self.filter_help(node, word, word_dict)
+        word_dict = dict(self.iter_words(top_k))
         end = time.time()
         print('Word filtering:', end - start)
         return word_dict
 
-    def filter_help(self, node, word, word_dict):
-        if node.children:
-            for char, child in node.children.items():
-                word += char
-                if self.valid_word(child, word):
-                    word_dict[word] = [child.freq, child.pmi, child.r_entropy, child.l_entropy]
-                self.filter_help(child, word, word_dict)
-                word = word[:-1]
-
-    def valid_word(self, node, word):
-        if self.MIN_WORD_LEN <= len(word) <= self.MAX_WORD_LEN \
-                and node.freq >= self.MIN_WORD_FREQ \
-                and node.pmi >= self.MIN_PMI \
-                and node.r_entropy >= self.MIN_ENTROPY \
-                and node.l_entropy >= self.MIN_ENTROPY \
-                and not self.has_stopword(word):
-            return True
-        return False
+    def save_lexicon(self, out_f, top_k=None):
+        """ Filters the words and writes them into a csv file as they are yielded, without a dict of the lexicon.
+        """
+        start = time.time()
+        self.write_csv(self.iter_words(top_k), out_f)
+        end = time.time()
+        print('Word filtering:', end - start)
 
     def has_stopword(self, word):
         """ Checks if a word contains stopwords, which are not able to construct words.
@@ -171,17 +247,16 @@ class PMIEntropyLexiconConstructor:
                 return True
         return False
 
-    @staticmethod
-    def save(lexicon, out_f):
+    @classmethod
+    def save(cls, lexicon, out_f):
         """ Saves the word detection result in a csv file.
         """
-        words = sorted(lexicon, key=lambda x: (len(x), -lexicon[x][0], -lexicon[x][1], -lexicon[x][2], -lexicon[x][3]))
+        words = sorted(lexicon, key=lambda x: (len(x),) + cls.rank((x, lexicon[x])))
+        cls.write_csv(((word, lexicon[word]) for word in words), out_f)
+
+    @staticmethod
+    def write_csv(rows, out_f):
         with open(out_f, 'w') as f:
             f.write('Word,Frequency,PMI,R_Entropy,L_Entropy\n')
-            for word in words:
-                f.write('{},{},{},{},{}\n'.format(
-                    word, lexicon[word][0], lexicon[word][1],
-                    lexicon[word][2], lexicon[word][3]))
-
-
-
+            for word, (freq, pmi, r_entropy, l_entropy) in rows:
+                f.write('{},{},{},{},{}\n'.format(word, freq, pmi, r_entropy, l_entropy))
@@ -0,0 +1,92 @@
+from functools import lru_cache
+
+"""
+The char level N-grams language model is scored again and again on the same short segments, e.g. the 1-4 char
+windows of the HMM tokenizer and the bigrams/trigrams of the CRF sentence taggers, so all components share one
+bounded LRU cache of segment scores around the loaded kenlm model.
+
+kenlm is imported where it is used, so the components could be imported without it.
+"""
+
+DEFAULT_CACHE_SIZE = 2 ** 18
+
+
+class CachedLM:
+    """ Wraps a kenlm language model with a bounded LRU cache of char segment scores.
+        Any other attribute is looked up on the wrapped model, so it can be used wherever a kenlm model is.
+    """
+
+    def __init__(self, lm, cache_size=DEFAULT_CACHE_SIZE):
+        self.lm = lm
+        self.cache_size = cache_size
+        self.seg_score = lru_cache(maxsize=cache_size)(self._seg_score)
+
+    def __getstate__(self):
+        # the loaded model cannot be pickled, so it is reloaded from its path, e.g. in worker processes
+        return {'path': self.lm.path, 'cache_size': self.cache_size}
+
+    def __setstate__(self, state):
+        import kenlm
+
+        self.__init__(kenlm.LanguageModel(state['path']), state['cache_size'])
+
+    def __getattr__(self, name):
+        if name == 'lm':
+            raise AttributeError(name)
+        return getattr(self.lm, name)
+
+    def _seg_score(self, seg):
+        """ Scores a char segment, without sentence beginning and ending tags. """
+        return self.lm.score(' '.join(seg), bos=False, eos=False)
+
+    @property
+    def hits(self):
+        return self.seg_score.cache_info().hits
+
+    @property
+    def misses(self):
+        return self.seg_score.cache_info().misses
+
+    def cache_info(self):
+        return self.seg_score.cache_info()
+
+    def cache_clear(self):
+        self.seg_score.cache_clear()
+
+    def cond_probs(self, chunk, order=4):
+        """ Computes log10 p(ck | ck-n+1 ... ck-1) of each char ck in the chunk, for n = 1 ... order, the same as
+            seg_score(ck-n+1 ... ck) - seg_score(ck-n+1 ... ck-1), but walks the chunk only once: the model states
+            after the last order - 1 histories are carried forward, so each conditional prob is a single lookup.
+            Impossible windows reaching before the chunk start, and zero log probs, get default low log prob -100.
+        """
+        from kenlm import State
+
+        lm = self.lm
+        null = State()
+        lm.NullContextWrite(null)
+
+        # the model states after the histories of length 0 ... order - 1 ending at previous char
+        histories = [null]
+        probs = []
+        for char in chunk:
+            char_probs = []
+            next_histories = [null]
+            for state in histories:
+                out = State()
+                char_probs.append(lm.BaseScore(state, char, out) or -100.0)
+                if len(next_histories) < order:
+                    next_histories.append(out)
+
+            if len(char_probs) < order:
+                char_probs.extend([-100.0] * (order - len(char_probs)))
+            probs.append(tuple(char_probs))
+            histories = next_histories
+
+        return probs
+
+
+def cached_lm(lm):
+    """ Wraps the given language model with a score cache, unless it already has one, or it is None. """
+    if lm is None or isinstance(lm, CachedLM):
+        return lm
+    return CachedLM(lm)
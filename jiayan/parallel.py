@@ -0,0 +1,93 @@
+import os
+from collections import deque
+from itertools import islice
+from types import GeneratorType
+
+"""
+Fans documents out over a pool of worker processes.
+
+The component (a tokenizer, sentencizer, punctuator or POS tagger) is handed to each worker once by the pool
+initializer, where it is unpickled by reloading its language model and CRF models from their paths, so every worker
+loads the models only once, then processes chunks of documents. Results come back in the input order, and only a
+few chunks per worker are in flight at a time, so a corpus of any size is processed with bounded memory.
+"""
+
+DEFAULT_CHUNKSIZE = 64
+
+# the component of current worker process
+_component = None
+
+
+def _init_worker(component):
+    global _component
+    _component = component
+
+
+def _apply(component, method, doc):
+    result = getattr(component, method)(doc)
+    # tokenizers yield words lazily, which cannot be sent back from workers
+    if isinstance(result, GeneratorType):
+        result = list(result)
+    return result
+
+
+def _apply_chunk(method, docs):
+    return [_apply(_component, method, doc) for doc in docs]
+
+
+def imap_chunks(component, method, docs, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    """ Applies the given method of the component to chunks of documents, with a pool of workers, yields
+        (chunk, results) pairs in the order of the documents. If workers is None, uses as many workers as cpu cores;
+        if workers is 1, processes the documents in current process.
+    """
+    docs = iter(docs)
+    chunks = iter(lambda: list(islice(docs, chunksize)), [])
+
+    if workers == 1:
+        for chunk in chunks:
+            yield chunk, [_apply(component, method, doc) for doc in chunk]
+        return
+
+    # multiprocessing takes a while to import, and is not needed by a single worker
+    from multiprocessing import Pool
+
+    workers = workers or os.cpu_count()
+    with Pool(workers, _init_worker, (component,)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append((chunk, pool.apply_async(_apply_chunk, (method, chunk))))
+            # keep each worker busy, but do not read ahead the whole input
+            if len(pending) >= 2 * workers:
+                chunk, results = pending.popleft()
+                yield chunk, results.get()
+
+        while pending:
+            chunk, results = pending.popleft()
+            yield chunk, results.get()
+
+
+def imap_batch(component, method, docs, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    """ Applies the given method of the component to each document, with a pool of workers, yields the results
+        in the order of the documents.
+    """
+    for _, results in imap_chunks(component, method, docs, workers, chunksize):
+        for result in results:
+            yield result
+
+
+def line_iterator(data_file):
+    """ Yields the stripped non-empty lines of a file lazily. """
+    with open(data_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def imap_file(component, method, data_file, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+    """ Applies the given method of the component to each line of a corpus file, with a pool of workers, yields
+        (line, result) pairs in the order of the file.
+    """
+    for lines, results in imap_chunks(component, method, line_iterator(data_file), workers, chunksize):
+        for line, result in zip(lines, results):
+            yield line, result
@@ -1,75 +1,68 @@
-import random
-from itertools import chain
 from string import ascii_uppercase
 
-import pycrfsuite
-from sklearn.metrics import classification_report
-from sklearn.preprocessing import LabelBinarizer
-
-from jiayan.globals import re_zh_exclude
+from jiayan import training
+from jiayan.features import FeatureTemplates
+from jiayan.parallel import DEFAULT_CHUNKSIZE, imap_batch, line_iterator
 
 
 class CRFPOSTagger:
 
+    # the tags not evaluated
+    EVAL_IGNORED_TAGS = ()
+
+    # the word patterns and types are not used
+    TEMPLATES = FeatureTemplates([
+        'bias',
+        ('0:word', 'gram1', 0),
+
+        ('-1:word', 'gram1', -1),
+        ('-10:words', 'gram2', -1),
+        ('BOS', -1),
+
+        ('-2:word', 'gram1', -2),
+        ('-21:words', 'gram2', -2),
+        ('-210:words', 'gram3', -2),
+
+        ('+1:word', 'gram1', 1),
+        ('+01:words', 'gram2', 0),
+        ('EOS', 1),
+
+        ('+2:word', 'gram1', 2),
+        ('+12:words', 'gram2', 1),
+        ('+012:chars', 'gram3', 0),
+
+        ('-11:words', 'skip', -1),
+        ('-101:words', 'gram3', -1),
+    ], sep='|')
+
     def __init__(self):
         self.tagger = None
+        self.model_path = None
+
+    def __getstate__(self):
+        # the loaded tagger cannot be pickled, so it is reloaded from its path, e.g. in worker processes
+        return {'model_path': self.model_path}
+
+    def __setstate__(self, state):
+        self.__init__()
+        if state['model_path']:
+            self.load(state['model_path'])
 
     def load(self, crf_model):
+        import pycrfsuite
+
         self.tagger = pycrfsuite.Tagger()
         self.tagger.open(crf_model)
+        self.model_path = crf_model
 
     def sent2features(self, sent):
-        length = len(sent)
-        feat_list = []
-        for i, word in enumerate(sent):
-            # pattern = self.get_word_pattern(word)
-            # is_zh = '1' if re_zh_exclude.match(word) else '0'
-            features = [
-                'bias',
-                '0:word=' + word,
-                # '0:pattern=' + pattern,
-                # '0:type=' + is_zh,
-            ]
-
-            if i > 0:
-                features.extend([
-                    '-1:word=' + sent[i - 1],
-                    '-10:words=' + '|'.join(sent[i - 1: i + 1]),
-                ])
-            else:
-                features.append('BOS')
-
-            if i > 1:
-                features.extend([
-                    '-2:word=' + sent[i - 2],
-                    '-21:words=' + '|'.join(sent[i - 2: i]),
-                    '-210:words=' + '|'.join(sent[i - 2: i + 1]),
-                ])
-
-            if i < length - 1:
-                features.extend([
-                    '+1:word=' + sent[i + 1],
-                    '+01:words=' + '|'.join(sent[i: i + 2]),
-                ])
-            else:
-                features.append('EOS')
-
-            if i < length - 2:
-                features.extend([
-                    '+2:word=' + sent[i + 2],
-                    '+12:words=' + '|'.join(sent[i + 1: i + 3]),
-                    '+012:chars=' + '|'.join(sent[i: i + 3]),
-                ])
-
-            if 0 < i < length - 1:
-                features.extend([
-                    '-11:words=' + sent[i - 1] + '|' + sent[i + 1],
-                    '-101:words=' + '|'.join(sent[i - 1: i + 2]),
-                ])
-
-            feat_list.append(features)
-
-        return feat_list
+        return self.TEMPLATES.features(sent)
+
+    def sent2items(self, sent):
+        """ The features of a list of words as an ItemSequence, processed once however many times it is tagged. """
+        import pycrfsuite
+
+        return pycrfsuite.ItemSequence(self.sent2features(sent))
 
     @staticmethod
     def get_word_pattern(word):
@@ -86,78 +79,52 @@ class CRFPOSTagger:
     def sent2tags(self, sent):
         pass
 
-    def train(self, train_x, train_y, out_model):
-        trainer = pycrfsuite.Trainer(verbose=False)
-        for x, y in zip(train_x, train_y):
-            if x and y:
-                trainer.append(x, y)
-
-        trainer.set_params({
-            'c1': 1.0,                            # coefficient for L1 penalty
-            'c2': 1e-3,                           # coefficient for L2 penalty
-            'max_iterations': 50,                 # stop earlier
-            'feature.possible_transitions': True  # include transitions that are possible, but not observed
-        })
-
-        trainer.train(out_model)
-        print(trainer.logparser.last_iteration)
-
-    def build_data(self, data_file):
+    def train(self, train_x, train_y, out_model, params=None):
+        training.train(zip(train_x, train_y), out_model, params)
+
+    def train_file(self, data_file, out_model, params=None, test_ratio=training.TEST_RATIO, temp_dir=None,
+                   workers=1):
+        """ Trains the model on a corpus file, streaming the examples of iter_data() into the trainer, then evaluates
+            it on the held-out examples, see jiayan.training. The features are made by a pool of workers if workers
+            is not 1, as many as cpu cores if None.
+        """
+        training.train_file(self, data_file, out_model, params, test_ratio, temp_dir, workers)
+
+    def iter_data(self, data_file, workers=1):
+        """ Yields the features and tags of each line of words and their tags of a corpus file, see
+            jiayan.training.iter_examples().
+        """
+        return training.iter_examples(self, line_iterator(data_file), workers)
+
+    def batch_examples(self, lines):
+        """ The list of the features and tags of a batch of lines of words and their tags. """
+        examples = []
+        for line in lines:
+            x, y = line.split('\t')
+            examples.append((self.sent2features(x.split()), y.split()))
+        return examples
+
+    def build_data(self, data_file, workers=1):
+        """ The lists of the features and tags of all the examples of a corpus file, see iter_data(). """
         X = []
         Y = []
-
-        with open(data_file, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    x, y = line.split('\t')
-                    feat_list = self.sent2features(x.split())
-                    tag_list = y.split()
-                    X.append(feat_list)
-                    Y.append(tag_list)
-
+        for feat_list, tag_list in self.iter_data(data_file, workers):
+            X.append(feat_list)
+            Y.append(tag_list)
         return X, Y
 
-    def split_data(self, X, Y):
-        random.seed(42)
-        rd_num = random.random()
-
-        def _rd():
-            return rd_num
-
-        random.shuffle(X, _rd)
-        random.shuffle(Y, _rd)
-
-        ratio = round(len(X) * 0.9)
-        return X[:ratio], Y[:ratio], X[ratio:], Y[ratio:]
+    def split_data(self, X, Y, test_ratio=training.TEST_RATIO):
+        return training.split_data(X, Y, test_ratio)
 
     def eval(self, test_x, test_y, crf_model):
-        tagger = pycrfsuite.Tagger()
-        tagger.open(crf_model)
-
-        y_pred = []
-        for feat_list in test_x:
-            preds = tagger.tag(feat_list)
-            y_pred.append(preds)
-
-        lb = LabelBinarizer()
-        y_true_all = lb.fit_transform(list(chain.from_iterable(test_y)))
-        y_pred_all = lb.transform(list(chain.from_iterable(y_pred)))
-
-        tagset = sorted(set(lb.classes_))
-        class_indices = {cls: idx for idx, cls in enumerate(lb.classes_)}
-
-        print(classification_report(
-            y_true_all,
-            y_pred_all,
-            labels=[class_indices[cls] for cls in tagset],
-            target_names=tagset,
-            digits=5
-        ))
+        training.evaluate(zip(test_x, test_y), crf_model, self.EVAL_IGNORED_TAGS)
 
     def postag(self, sent):
-        feat_list = self.sent2features(sent)
-        tags = self.tagger.tag(feat_list)
+        tags = self.tagger.tag(self.sent2items(sent))
         return tags
 
+    def postag_batch(self, sents, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+        """ POS tags word lists with a pool of workers, yields the tag lists in order. """
+        return imap_batch(self, 'postag', sents, workers, chunksize)
+
 
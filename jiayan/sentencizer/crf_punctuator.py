@@ -1,106 +1,75 @@
-from itertools import chain
-
-import pycrfsuite
-from sklearn.metrics import classification_report
-from sklearn.preprocessing import LabelBinarizer
-
+from jiayan.features import FeatureTemplates
 from jiayan.globals import re_puncs_include, re_zh_exclude
-from jiayan.utils import text_iterator
+from jiayan.parallel import DEFAULT_CHUNKSIZE, imap_batch
 from jiayan.sentencizer.crf_sent_tagger import CRFSentTagger
 from jiayan.sentencizer.crf_sentencizer import CRFSentencizer
 
 
 class CRFPunctuator(CRFSentTagger):
 
+    # only the punctuations are evaluated
+    EVAL_IGNORED_TAGS = ('B', 'M', 'E3', 'E2')
+
+    # the features of the PMI and the sentencizer tags of the neighbors are not used
+    TEMPLATES = FeatureTemplates([
+        'bias',
+        ('0:char', 'gram1', 0),
+        ('0:tag', 'tag', 0),
+
+        ('-1:char', 'gram1', -1),
+        ('-10:chars', 'gram2', -1),
+        ('BOS', -1),
+
+        ('-2:char', 'gram1', -2),
+        ('-21:chars', 'gram2', -2),
+        ('-210:chars', 'gram3', -2),
+
+        ('-3:char', 'gram1', -3),
+        ('-321:chars', 'gram3', -3),
+        ('-3210:chars', 'gram4', -3),
+
+        ('+1:char', 'gram1', 1),
+        ('+01:chars', 'gram2', 0),
+        ('EOS', 1),
+
+        ('+2:char', 'gram1', 2),
+        ('+12:chars', 'gram2', 1),
+        ('+012:chars', 'gram3', 0),
+
+        ('+3:char', 'gram1', 3),
+        ('+123:chars', 'gram3', 1),
+        ('+0123:chars', 'gram4', 0),
+
+        ('-11:chars', 'skip', -1),
+        ('-101:chars', 'gram3', -1),
+        ('-101:ttest', 'ttest', -1),
+    ], sizes={'tag': 1, 'ttest': 3})
+
     def __init__(self, lm, cut_model):
         super(CRFPunctuator, self).__init__(lm)
-        self.sentencizer = CRFSentencizer(lm)
+        # share the score cache with the sentencizer
+        self.sentencizer = CRFSentencizer(self.lm)
         self.sentencizer.load(cut_model)
 
-    def sent2features(self, sent: str, tags=None):
-        length = len(sent)
-        feat_list = []
-        for i, char in enumerate(sent):
-            features = [
-                'bias',
-                '0:char=' + char,
-                '0:tag=' + tags[i],
-            ]
-
-            if i > 0:
-                features.extend([
-                    '-1:char=' + sent[i - 1],
-                    '-10:chars=' + sent[i - 1: i + 1],
-                    # '-10:pmi=' + self.get_pmi(sent[i - 1: i + 1]),
-
-                    # '-1:tag=' + tags[i - 1],
-                    # '-10:tags=' + tags[i - 1: i + 1],
-                ])
-            else:
-                features.append('BOS')
-
-            if i > 1:
-                features.extend([
-                    '-2:char=' + sent[i - 2],
-                    '-21:chars=' + sent[i - 2: i],
-                    '-210:chars=' + sent[i - 2: i + 1],
-
-                    # '-21:tags=' + tags[i - 2: i],
-                    # '-210:tags=' + tags[i - 2: i + 1],
-                ])
-
-            if i > 2:
-                features.extend([
-                    '-3:char=' + sent[i - 3],
-                    '-321:chars=' + sent[i - 3: i],
-                    '-3210:chars=' + sent[i - 3: i + 1],
-                ])
-
-            if i < length - 1:
-                features.extend([
-                    '+1:char=' + sent[i + 1],
-                    '+01:chars=' + sent[i: i + 2],
-                    # '+01:pmi=' + self.get_pmi(sent[i: i + 2]),
-
-                    # '+1:tag=' + tags[i + 1],
-                    # '+01:tags=' + tags[i: i + 2],
-                ])
-            else:
-                features.append('EOS')
-
-            if i < length - 2:
-                features.extend([
-                    '+2:char=' + sent[i + 2],
-                    '+12:chars=' + sent[i + 1: i + 3],
-                    '+012:chars=' + sent[i: i + 3],
-
-                    # '+12:tags=' + tags[i + 1: i + 3],
-                    # '+012:tags=' + tags[i: i + 3],
-                ])
-
-            if i < length - 3:
-                features.extend([
-                    '+3:char=' + sent[i + 3],
-                    '+123:chars=' + sent[i + 1: i + 4],
-                    '+0123:chars=' + sent[i: i + 4],
-                ])
-
-            if 0 < i < length - 1:
-                features.extend([
-                    '-11:chars=' + sent[i - 1] + sent[i + 1],
-                    '-101:chars=' + sent[i - 1: i + 2],
-                    '-101:ttest=' + self.get_ttest(sent[i - 1: i + 2]),
-                ])
-
-            feat_list.append(features)
-
-        return feat_list
+    def load_lm_table(self, table_f):
+        super(CRFPunctuator, self).load_lm_table(table_f)
+        self.sentencizer.lm_table = self.lm_table
+
+    def sent2features(self, sent: str, tags=None, columns=None):
+        columns = self.lm_columns(sent, columns)
+        columns['tag'] = tags
+        return self.TEMPLATES.features(sent, columns)
+
+    def sent2items(self, sent: str, tags=None, columns=None):
+        import pycrfsuite
+
+        return pycrfsuite.ItemSequence(self.sent2features(sent, tags, columns))
 
     def punctuate(self, text):
-        cut_feat_list = self.sentencizer.sent2features(text)
-        cut_tags = self.sentencizer.tagger.tag(cut_feat_list)
-        punc_feat_list = self.sent2features(text, cut_tags)
-        punc_tags = self.tagger.tag(punc_feat_list)
+        # the char n-grams and the LM features are computed once, for both the sentencizer and the punctuator
+        columns = {}
+        cut_tags = self.sentencizer.tagger.tag(self.sentencizer.sent2items(text, columns=columns))
+        punc_tags = self.tagger.tag(self.sent2items(text, cut_tags, columns))
 
         sents = []
         sent = ''
@@ -122,25 +91,33 @@ class CRFPunctuator(CRFSentTagger):
 
         return ''.join(sents)
 
-    def build_data(self, data_file):
-        X = []
-        Y = []
-        for line in text_iterator(data_file, keep_punc=True):
-            texts = [text for text in re_puncs_include.split(line) if text]
-            texts = self.process_texts(texts)
+    def punctuate_batch(self, texts, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+        """ Punctuates texts with a pool of workers, yields the punctuated texts in order. """
+        return imap_batch(self, 'punctuate', texts, workers, chunksize)
 
+    def batch_examples(self, lines):
+        examples = []
+        lines_sents = [self.punctuated_sents(line) for line in lines]
+        # the LM features of the sentences of all the lines are looked up at once
+        lines_columns = iter(self.batch_lm_columns([sent for sents in lines_sents for sent, _ in sents]))
+
+        for sents in lines_sents:
             feat_list = []
             punc_tags = []
-            for i in range(len(texts) - 1):
-                if re_zh_exclude.match(texts[i]) and texts[i + 1] in self.punc2tag:
-                    cut_tags = self.sent2tags(texts[i])
-                    feat_list.extend(self.sent2features(texts[i], cut_tags))
-                    punc_tags.extend(self.sent2tags(texts[i], texts[i + 1]))
+            for sent, punc in sents:
+                cut_tags = self.sent2tags(sent)
+                feat_list.extend(self.sent2features(sent, cut_tags, next(lines_columns)))
+                punc_tags.extend(self.sent2tags(sent, punc))
 
-            X.append(feat_list)
-            Y.append(punc_tags)
+            examples.append((feat_list, punc_tags))
+        return examples
 
-        return X, Y
+    def punctuated_sents(self, line):
+        """ The (sentence, punctuation) pairs of a training line. """
+        texts = [text for text in re_puncs_include.split(line) if text]
+        texts = self.process_texts(texts)
+        return [(texts[i], texts[i + 1]) for i in range(len(texts) - 1)
+                if re_zh_exclude.match(texts[i]) and texts[i + 1] in self.punc2tag]
 
     def process_texts(self, texts):
         while texts and texts[0] in self.punc2tag:
@@ -150,30 +127,3 @@ class CRFPunctuator(CRFSentTagger):
             texts.append('。')
 
         return texts
-
-    def eval(self, test_x, test_y, crf_model):
-        tagger = pycrfsuite.Tagger()
-        tagger.open(crf_model)
-
-        pred_y = []
-        for feat_list in test_x:
-            preds = tagger.tag(feat_list)
-            pred_y.append(preds)
-
-        y_trues = [tag for tag in list(chain.from_iterable(test_y)) if tag not in {'B', 'M', 'E3', 'E2'}]
-        y_preds = [tag for tag in list(chain.from_iterable(pred_y)) if tag not in {'B', 'M', 'E3', 'E2'}]
-
-        lb = LabelBinarizer()
-        y_true_all = lb.fit_transform(y_trues)
-        y_pred_all = lb.transform(y_preds)
-
-        tagset = sorted(set(lb.classes_))
-        class_indices = {cls: idx for idx, cls in enumerate(lb.classes_)}
-
-        print(classification_report(
-            y_true_all,
-            y_pred_all,
-            labels=[class_indices[cls] for cls in tagset],
-            target_names=tagset,
-            digits=5
-        ))
@@ -1,16 +1,22 @@
-import random
-from itertools import chain
-
-import pycrfsuite
-from sklearn.metrics import classification_report
-from sklearn.preprocessing import LabelBinarizer
+from jiayan import training
+from jiayan.globals import re_puncs_exclude
+from jiayan.lm import cached_lm
+from jiayan.utils import text_iterator
 
 
 class CRFSentTagger:
 
+    # the tags not evaluated
+    EVAL_IGNORED_TAGS = ()
+
     def __init__(self, lm):
-        self.lm = lm
+        """ The lm may be None if the LM features of all the sentences are in the table loaded by load_lm_table(),
+            e.g. of a training corpus.
+        """
+        self.lm = cached_lm(lm)
+        self.lm_table = None
         self.tagger = None
+        self.model_path = None
 
         # for feature extraction of punctuator
         self.punc2tag = {
@@ -34,11 +40,50 @@ class CRFSentTagger:
             'F': '；',
         }
 
+    def __getstate__(self):
+        # the loaded tagger cannot be pickled, so it is reloaded from its path, e.g. in worker processes
+        state = self.__dict__.copy()
+        state['tagger'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.model_path:
+            self.load(self.model_path)
+
     def load(self, crf_model):
+        import pycrfsuite
+
         self.tagger = pycrfsuite.Tagger()
         self.tagger.open(crf_model)
+        self.model_path = crf_model
+
+    def build_lm_table(self, data_file, table_f):
+        """ Scores the distinct bigrams and trigrams of the texts of a training corpus file once, saves their LM
+            features into a table file, and loads it. The table of a corpus serves both the sentencizer and the
+            punctuator, for the texts of the punctuator are parts of the texts of the sentencizer.
+        """
+        # numpy is only imported with an lm table
+        from jiayan.sentencizer.lm_table import LMFeatureTable
+
+        texts = (''.join(re_puncs_exclude.split(line)) for line in text_iterator(data_file, keep_punc=True))
+        LMFeatureTable.build(self.lm, texts).save(table_f)
+        self.load_lm_table(table_f)
+
+    def load_lm_table(self, table_f):
+        """ Gets the LM features from the table, instead of the language model, of the sentences in it. """
+        from jiayan.sentencizer.lm_table import LMFeatureTable
+
+        self.lm_table = LMFeatureTable.load(table_f)
+
+    def sent2features(self, sent: str, tags=None, columns=None):
+        """ The columns are the dict of the columns of the sentence computed so far, see FeatureTemplates.features(),
+            the columns computed are added to it, to be shared by the sentencizer and the punctuator.
+        """
+        pass
 
-    def sent2features(self, sent: str, tags=None):
+    def sent2items(self, sent: str, tags=None, columns=None):
+        """ The features of a sentence as an ItemSequence, processed once however many times it is tagged. """
         pass
 
     def sent2tags(self, sent: str, punc=''):
@@ -66,8 +111,49 @@ class CRFSentTagger:
         return tags
 
     def get_pmi(self, seg):
-        pmi = self.lm.score(' '.join(seg), eos=False, bos=False) - \
-              (self.lm.score(seg[0], eos=False, bos=False) + self.lm.score(seg[1], eos=False, bos=False))
+        pmi = self.lm.seg_score(seg) - (self.lm.seg_score(seg[0]) + self.lm.seg_score(seg[1]))
+        return self.pmi_feature(pmi)
+
+    def get_ttest(self, seg):
+        former = self.lm.seg_score(seg[:2]) - self.lm.seg_score(seg[0])
+        latter = self.lm.seg_score(seg[1:]) - self.lm.seg_score(seg[1])
+        return self.ttest_feature(former - latter)
+
+    def lm_columns(self, sent, columns=None):
+        """ Adds the PMI features of all the bigrams and the t-test features of all the trigrams of a sentence to the
+            dict of its columns, unless they are there. The features are the same as get_pmi() and get_ttest() of
+            each, but each char and bigram of the sentence is scored only once.
+        """
+        if columns is None:
+            columns = {}
+        if 'ttest' in columns:
+            return columns
+        if self.lm_table is not None:
+            found = self.lm_table.columns(sent)
+            if found:
+                columns['pmi'], columns['ttest'] = found
+                return columns
+            if self.lm is None:
+                raise ValueError('The LM features of the sentence are not in the table, and no LM is given: ' + sent)
+
+        seg_score = self.lm.seg_score
+        chars = [seg_score(char) for char in sent]
+        bigrams = [seg_score(sent[j: j + 2]) for j in range(len(sent) - 1)]
+        pmis = [self.pmi_feature(score - (chars[j] + chars[j + 1])) for j, score in enumerate(bigrams)]
+        ttests = [self.ttest_feature((bigrams[j] - chars[j]) - (bigrams[j + 1] - chars[j + 1]))
+                  for j in range(len(sent) - 2)]
+        columns.update(pmi=pmis, ttest=ttests)
+        return columns
+
+    def batch_lm_columns(self, sents):
+        """ The lm_columns() of each of the sentences, those in the table looked up at once. """
+        if self.lm_table is None:
+            return [self.lm_columns(sent) for sent in sents]
+        return [{'pmi': found[0], 'ttest': found[1]} if found else self.lm_columns(sent)
+                for sent, found in zip(sents, self.lm_table.batch_columns(sents))]
+
+    @staticmethod
+    def pmi_feature(pmi):
         if pmi >= 2:
             return '2'
         elif pmi >= 1.5:
@@ -78,10 +164,8 @@ class CRFSentTagger:
             return '0.5'
         return '0'
 
-    def get_ttest(self, seg):
-        former = self.lm.score(' '.join(seg[:2]), eos=False, bos=False) - self.lm.score(seg[0], eos=False, bos=False)
-        latter = self.lm.score(' '.join(seg[1:]), eos=False, bos=False) - self.lm.score(seg[1], eos=False, bos=False)
-        diff = former - latter
+    @staticmethod
+    def ttest_feature(diff):
         if diff > 0:
             return 'l'
         elif diff == 0:
@@ -89,60 +173,36 @@ class CRFSentTagger:
         else:
             return 'r'
 
-    def train(self, train_x, train_y, out_model):
-        trainer = pycrfsuite.Trainer(verbose=False)
-        for x, y in zip(train_x, train_y):
-            if x and y:
-                trainer.append(x, y)
+    def train(self, train_x, train_y, out_model, params=None):
+        training.train(zip(train_x, train_y), out_model, params)
 
-        trainer.set_params({
-            'c1': 1.0,                            # coefficient for L1 penalty
-            'c2': 1e-3,                           # coefficient for L2 penalty
-            'max_iterations': 50,                 # stop earlier
-            'feature.possible_transitions': True  # include transitions that are possible, but not observed
-        })
+    def train_file(self, data_file, out_model, params=None, test_ratio=training.TEST_RATIO, temp_dir=None,
+                   workers=1):
+        """ Trains the model on a corpus file, streaming the examples of iter_data() into the trainer, then evaluates
+            it on the held-out examples, see jiayan.training. The features are made by a pool of workers if workers
+            is not 1, as many as cpu cores if None.
+        """
+        training.train_file(self, data_file, out_model, params, test_ratio, temp_dir, workers)
 
-        trainer.train(out_model)
-        print(trainer.logparser.last_iteration)
+    def iter_data(self, data_file, workers=1):
+        """ Yields the features and tags of each example of a corpus file, see jiayan.training.iter_examples(). """
+        return training.iter_examples(self, text_iterator(data_file, keep_punc=True), workers)
 
-    def build_data(self, data_file):
+    def batch_examples(self, lines):
+        """ The list of the features and tags of the examples of a batch of corpus lines. """
         pass
 
-    def split_data(self, X, Y):
-        random.seed(42)
-        rd_num = random.random()
+    def build_data(self, data_file, workers=1):
+        """ The lists of the features and tags of all the examples of a corpus file, see iter_data(). """
+        X = []
+        Y = []
+        for feat_list, tag_list in self.iter_data(data_file, workers):
+            X.append(feat_list)
+            Y.append(tag_list)
+        return X, Y
 
-        def _rd():
-            return rd_num
-
-        random.shuffle(X, _rd)
-        random.shuffle(Y, _rd)
-
-        ratio = round(len(X) * 0.9)
-        return X[:ratio], Y[:ratio], X[ratio:], Y[ratio:]
+    def split_data(self, X, Y, test_ratio=training.TEST_RATIO):
+        return training.split_data(X, Y, test_ratio)
 
     def eval(self, test_x, test_y, crf_model):
-        tagger = pycrfsuite.Tagger()
-        tagger.open(crf_model)
-
-        y_pred = []
-        for feat_list in test_x:
-            preds = tagger.tag(feat_list)
-            y_pred.append(preds)
-
-        lb = LabelBinarizer()
-        y_true_all = lb.fit_transform(list(chain.from_iterable(test_y)))
-        y_pred_all = lb.transform(list(chain.from_iterable(y_pred)))
-
-        tagset = sorted(set(lb.classes_))
-        class_indices = {cls: idx for idx, cls in enumerate(lb.classes_)}
-
-        print(classification_report(
-            y_true_all,
-            y_pred_all,
-            labels=[class_indices[cls] for cls in tagset],
-            target_names=tagset,
-            digits=5
-        ))
-
-
+        training.evaluate(zip(test_x, test_y), crf_model, self.EVAL_IGNORED_TAGS)
@@ -1,70 +1,51 @@
 from itertools import chain
 
+from jiayan.features import FeatureTemplates
 from jiayan.globals import re_puncs_exclude
-from jiayan.utils import text_iterator
+from jiayan.parallel import DEFAULT_CHUNKSIZE, imap_batch
 from jiayan.sentencizer.crf_sent_tagger import CRFSentTagger
 
 
 class CRFSentencizer(CRFSentTagger):
 
+    TEMPLATES = FeatureTemplates([
+        'bias',
+        ('0:char', 'gram1', 0),
+
+        ('-1:char', 'gram1', -1),
+        ('-10:chars', 'gram2', -1),
+        ('-10:pmi', 'pmi', -1),
+        ('BOS', -1),
+
+        ('-21:chars', 'gram2', -2),
+        ('-210:chars', 'gram3', -2),
+
+        ('+1:char', 'gram1', 1),
+        ('+01:chars', 'gram2', 0),
+        ('+01:pmi', 'pmi', 0),
+        ('EOS', 1),
+
+        ('+12:chars', 'gram2', 1),
+        ('+012:chars', 'gram3', 0),
+
+        ('-11:chars', 'skip', -1),
+        ('-101:chars', 'gram3', -1),
+        ('-101:ttest', 'ttest', -1),
+    ], sizes={'pmi': 2, 'ttest': 3})
+
     def __init__(self, lm):
         super(CRFSentencizer, self).__init__(lm)
 
-    def sent2features(self, sent: str, tags=None):
-        length = len(sent)
-        feat_list = []
-        for i, char in enumerate(sent):
-            features = [
-                'bias',
-                '0:char=' + char,
-            ]
-
-            if i > 0:
-                features.extend([
-                    '-1:char=' + sent[i - 1],
-                    '-10:chars=' + sent[i - 1: i + 1],
-                    '-10:pmi=' + self.get_pmi(sent[i - 1: i + 1]),
-                ])
-            else:
-                features.append('BOS')
-
-            if i > 1:
-                features.extend([
-                    # '-2:char=' + sent[i - 2],
-                    '-21:chars=' + sent[i - 2: i],
-                    '-210:chars=' + sent[i - 2: i + 1],
-                ])
-
-            if i < length - 1:
-                features.extend([
-                    '+1:char=' + sent[i + 1],
-                    '+01:chars=' + sent[i: i + 2],
-                    '+01:pmi=' + self.get_pmi(sent[i: i + 2]),
-                ])
-            else:
-                features.append('EOS')
-
-            if i < length - 2:
-                features.extend([
-                    # '+2:char=' + sent[i + 2],
-                    '+12:chars=' + sent[i + 1: i + 3],
-                    '+012:chars=' + sent[i: i + 3],
-                ])
-
-            if 0 < i < length - 1:
-                features.extend([
-                    '-11:chars=' + sent[i - 1] + sent[i + 1],
-                    '-101:chars=' + sent[i - 1: i + 2],
-                    '-101:ttest=' + self.get_ttest(sent[i - 1: i + 2]),
-                ])
-
-            feat_list.append(features)
-
-        return feat_list
+    def sent2features(self, sent: str, tags=None, columns=None):
+        return self.TEMPLATES.features(sent, self.lm_columns(sent, columns))
+
+    def sent2items(self, sent: str, tags=None, columns=None):
+        import pycrfsuite
+
+        return pycrfsuite.ItemSequence(self.sent2features(sent, tags, columns))
 
     def sentencize(self, text):
-        feat_list = self.sent2features(text)
-        tags = self.tagger.tag(feat_list)
+        tags = self.tagger.tag(self.sent2items(text))
 
         sents = []
         sent = ''
@@ -85,17 +66,18 @@ class CRFSentencizer(CRFSentTagger):
 
         return sents
 
-    def build_data(self, data_file):
-        X = []
-        Y = []
+    def sentencize_batch(self, texts, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+        """ Sentencizes texts with a pool of workers, yields the sentence lists in order. """
+        return imap_batch(self, 'sentencize', texts, workers, chunksize)
 
-        for line in text_iterator(data_file, keep_punc=True):
-            sents = [sent for sent in re_puncs_exclude.split(line) if sent]
-            feat_list = self.sent2features(''.join(sents))
+    def batch_examples(self, lines):
+        examples = []
+        lines_sents = [[sent for sent in re_puncs_exclude.split(line) if sent] for line in lines]
+        texts = [''.join(sents) for sents in lines_sents]
+        for sents, text, columns in zip(lines_sents, texts, self.batch_lm_columns(texts)):
+            feat_list = self.sent2features(text, columns=columns)
             tag_list = list(chain.from_iterable([self.sent2tags(sent) for sent in sents]))
-            X.append(feat_list)
-            Y.append(tag_list)
-
-        return X, Y
+            examples.append((feat_list, tag_list))
+        return examples
 
 
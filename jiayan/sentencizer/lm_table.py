@@ -0,0 +1,220 @@
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+"""
+The LM features of the CRF sentence taggers, precomputed for a training corpus.
+
+The sentencizer and the punctuator get the PMI feature of each char bigram and the t-test feature of each char trigram
+from the language model, which makes building the features of a big training corpus slow, again for each training
+run. The table scores each distinct bigram and trigram of the corpus only once, and keeps their feature labels, so the
+features of the corpus are built again and again without the language model.
+
+An n-gram of at most 3 chars is packed into a 64 bit key of 21 bits per char code, and the table keeps the sorted keys
+of the bigrams and trigrams, and a byte of the label of each, so it is about 9 bytes per n-gram. The table file is
+memory mapped, and the keys of a batch of sentences are looked up at once with binary search.
+"""
+
+PMI_LABELS = ('0', '0.5', '1', '1.5', '2')
+# the lower bounds of the PMI labels above '0'
+PMI_BOUNDS = np.array([0.5, 1, 1.5, 2])
+# indexed by the sign of the t-test diff + 1
+TTEST_LABELS = ('r', 'u', 'l')
+
+CHAR_BITS = np.uint64(21)
+
+# the table file header: magic, format version, number of bigrams, number of trigrams, padded to 8 bytes
+TABLE_HEADER = struct.Struct('<8sIqq4x')
+TABLE_MAGIC = b'JIAYANLM'
+TABLE_VERSION = 1
+
+# the texts are scanned in batches of about this many chars, and the keys collected are merged at about this many
+BATCH_CHARS = 2 ** 20
+MERGE_KEYS = 2 ** 22
+
+
+def char_codes(text):
+    return np.frombuffer(text.encode('utf-32-le'), np.uint32).astype(np.uint64)
+
+
+def gram_keys(codes, n):
+    """ The keys of the n-grams starting at each position of the char codes. """
+    size = max(len(codes) - n + 1, 0)
+    keys = codes[:size].copy()
+    for k in range(1, n):
+        keys = (keys << CHAR_BITS) | codes[k:k + size]
+    return keys
+
+
+def key_grams(keys, n):
+    """ The n-gram strings of the keys. """
+    mask = (1 << int(CHAR_BITS)) - 1
+    return [''.join(chr(key >> (int(CHAR_BITS) * k) & mask) for k in range(n - 1, -1, -1)) for key in keys.tolist()]
+
+
+class KeySet:
+    """ Collects the distinct keys in sorted arrays, merged once enough keys are collected. """
+
+    def __init__(self):
+        self.keys = np.zeros(0, np.uint64)
+        self.pending = []
+        self.size = 0
+
+    def add(self, keys):
+        self.pending.append(np.unique(keys))
+        self.size += len(self.pending[-1])
+        if self.size >= max(len(self.keys), MERGE_KEYS):
+            self.merge()
+
+    def merge(self):
+        self.keys = np.unique(np.concatenate([self.keys] + self.pending))
+        self.pending = []
+        self.size = 0
+        return self.keys
+
+
+class LMFeatureTable:
+
+    def __init__(self, bigrams, pmis, trigrams, ttests, path=None):
+        """ The sorted keys of the bigrams and trigrams, and the indexes of their PMI and t-test labels. """
+        self.bigrams = bigrams
+        self.pmis = pmis
+        self.trigrams = trigrams
+        self.ttests = ttests
+        self.path = path
+        self.pmi_labels = np.array(PMI_LABELS, dtype=object)
+        self.ttest_labels = np.array(TTEST_LABELS, dtype=object)
+
+    def __len__(self):
+        return len(self.bigrams) + len(self.trigrams)
+
+    def __getstate__(self):
+        # a loaded table is reloaded from its path, e.g. in worker processes, instead of copying the arrays
+        if self.path:
+            return {'path': self.path}
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        if 'bigrams' in state:
+            self.__dict__.update(state)
+        else:
+            self.__dict__.update(self.load(state['path']).__dict__)
+
+    @classmethod
+    def build(cls, lm, texts):
+        """ Scores all the distinct bigrams and trigrams of the texts with the language model, each char and bigram
+            scored once, the same as CRFSentTagger.get_pmi() and get_ttest() of each.
+        """
+        bigram_set = KeySet()
+        trigram_set = KeySet()
+        batch = []
+        chars = 0
+        for text in texts:
+            batch.append(text)
+            chars += len(text)
+            if chars >= BATCH_CHARS:
+                cls._collect(batch, bigram_set, trigram_set)
+                batch = []
+                chars = 0
+        cls._collect(batch, bigram_set, trigram_set)
+        bigrams = bigram_set.merge()
+        trigrams = trigram_set.merge()
+
+        mask = np.uint64((1 << int(CHAR_BITS)) - 1)
+        chars = np.unique(np.concatenate([bigrams >> CHAR_BITS, bigrams & mask]))
+        char_scores = np.array([lm.seg_score(char) for char in key_grams(chars, 1)], np.float64)
+        bigram_scores = np.array([lm.seg_score(bigram) for bigram in key_grams(bigrams, 2)], np.float64)
+
+        def char_score(codes):
+            return char_scores[np.searchsorted(chars, codes)]
+
+        pmis = bigram_scores - (char_score(bigrams >> CHAR_BITS) + char_score(bigrams & mask))
+        # the bigrams of a trigram are in the texts too
+        former = bigram_scores[np.searchsorted(bigrams, trigrams >> CHAR_BITS)] \
+            - char_score(trigrams >> (CHAR_BITS * np.uint64(2)))
+        latter = bigram_scores[np.searchsorted(bigrams, trigrams & ((mask << CHAR_BITS) | mask))] \
+            - char_score((trigrams >> CHAR_BITS) & mask)
+
+        return cls(bigrams, np.searchsorted(PMI_BOUNDS, pmis, side='right').astype(np.uint8),
+                   trigrams, (np.sign(former - latter) + 1).astype(np.uint8))
+
+    @staticmethod
+    def _collect(texts, bigram_set, trigram_set):
+        if not texts:
+            return
+        # the texts are joined by a 0 code, and the n-grams with it are dropped
+        codes = char_codes('\0'.join(texts))
+        valid = codes != 0
+        bigram_set.add(gram_keys(codes, 2)[valid[:-1] & valid[1:]])
+        trigram_set.add(gram_keys(codes, 3)[valid[:-2] & valid[1:-1] & valid[2:]])
+
+    def columns(self, sent):
+        """ The PMI features of all the bigrams and the t-test features of all the trigrams of a sentence, or None if
+            any of them is not in the table.
+        """
+        return self.batch_columns([sent])[0]
+
+    def batch_columns(self, sents):
+        """ The columns() of each of the sentences, looked up at once, which is much faster for short sentences. """
+        # the sentences are joined by a 0 code, the n-grams with it are looked up too, but not used
+        codes = char_codes('\0'.join(sents))
+        lengths = np.fromiter(map(len, sents), np.int64, len(sents))
+        starts = np.cumsum(lengths + 1) - (lengths + 1)
+
+        results = []
+        for n, table_keys, labels, names in ((2, self.bigrams, self.pmis, self.pmi_labels),
+                                             (3, self.trigrams, self.ttests, self.ttest_labels)):
+            keys = gram_keys(codes, n)
+            if len(table_keys):
+                positions = np.minimum(np.searchsorted(table_keys, keys), len(table_keys) - 1)
+                found = table_keys[positions] == keys
+                values = names[labels[positions]].tolist()
+            else:
+                found = np.zeros(len(keys), bool)
+                values = [None] * len(keys)
+            counts = np.maximum(lengths - n + 1, 0)
+            # the number of the n-grams not found before each position
+            missing = np.concatenate([[0], np.cumsum(~found)])
+            ends = np.minimum(starts + counts, len(keys))
+            missing = (missing[ends] - missing[np.minimum(starts, ends)]).tolist()
+            results.append([None if miss else values[start:start + count] for start, count, miss in
+                            zip(starts.tolist(), counts.tolist(), missing)])
+        return [(pmis, ttests) if pmis is not None and ttests is not None else None for pmis, ttests in zip(*results)]
+
+    def save(self, table_f):
+        """ Writes the table to a temp file first, then renames it, so it is never left half written. """
+        fd, temp_f = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(table_f)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(TABLE_HEADER.pack(TABLE_MAGIC, TABLE_VERSION, len(self.bigrams), len(self.trigrams)))
+                f.write(self.bigrams.astype('<u8').tobytes())
+                f.write(self.trigrams.astype('<u8').tobytes())
+                f.write(self.pmis.astype(np.uint8).tobytes())
+                f.write(self.ttests.astype(np.uint8).tobytes())
+            os.replace(temp_f, table_f)
+        except BaseException:
+            os.remove(temp_f)
+            raise
+
+    @classmethod
+    def load(cls, table_f):
+        """ Maps the arrays of a table file into memory, so the processes loading it share the pages. """
+        with open(table_f, 'rb') as f:
+            header = f.read(TABLE_HEADER.size)
+        if len(header) < TABLE_HEADER.size:
+            raise ValueError('Not an LM feature table file: {}'.format(table_f))
+        magic, version, n_bigrams, n_trigrams = TABLE_HEADER.unpack(header)
+        if magic != TABLE_MAGIC:
+            raise ValueError('Not an LM feature table file: {}'.format(table_f))
+        if version != TABLE_VERSION:
+            raise ValueError('Unsupported LM feature table version {}: {}'.format(version, table_f))
+
+        arrays = []
+        offset = TABLE_HEADER.size
+        for dtype, size in (('<u8', n_bigrams), ('<u8', n_trigrams), (np.uint8, n_bigrams), (np.uint8, n_trigrams)):
+            arrays.append(np.memmap(table_f, dtype, 'r', offset, (size,)) if size else np.zeros(0, dtype))
+            offset += np.dtype(dtype).itemsize * size
+        bigrams, trigrams, pmis, ttests = arrays
+        return cls(bigrams, pmis, trigrams, ttests, os.path.abspath(table_f))
@@ -0,0 +1,211 @@
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+"""
+A precompiled table of the emission probs of CharHMMTokenizer, so tokenizing does not need the language model.
+
+The emission probs of a char are log10 p(ck | ck-n+1 ... ck-1) of the windows of n = 1 ... 4 chars ending at it, see
+CachedLM.cond_probs(). The windows of the texts of a domain are finite, so the table scores every window of a
+reference corpus once with the language model, and keeps them in a sorted array: a window of n zh chars, all in
+[一-龥], is packed into a 64 bit key of n - 1 in the top bits and 15 bits per char, and its prob is a float32,
+which is exactly the float kenlm scores with. A window not in the table gets the backoff prob of its length, by
+default the log prob of an unknown char of the language model, as if the window were never seen.
+
+The table file is memory mapped, so the processes loading it share the pages, and all the windows of a batch of chunks
+are looked up at once with one binary search.
+"""
+
+CHAR_BASE = 0x4E00
+CHAR_LAST = 0x9FA5
+CHAR_BITS = np.uint64(15)
+# the id of the chars not in the zh range, never in a key of the table
+UNKNOWN_ID = np.uint64(2 ** 15 - 1)
+LENGTH_SHIFT = np.uint64(60)
+# the last key of the table, greater than any key, so a binary search never runs off the end
+SENTINEL_KEY = np.uint64(2 ** 64 - 1)
+
+DEFAULT_ORDER = 4
+# the log prob of the impossible windows reaching before the chunk start, and of zero log probs, as cond_probs()
+IMPOSSIBLE_PROB = -100.0
+
+# the table file header: magic, format version, order, number of keys
+TABLE_HEADER = struct.Struct('<8sIIq')
+TABLE_MAGIC = b'JIAYANEM'
+TABLE_VERSION = 1
+
+# the texts are scored in batches of about this many chars
+BATCH_CHARS = 2 ** 18
+
+
+def window_keys(chunk, order):
+    """ The keys of the windows of n = 1 ... order chars ending at each char of the chunk, in a len(chunk) x order
+        array, the windows reaching before the chunk start are not valid keys.
+    """
+    codes = np.frombuffer(chunk.encode('utf-32-le'), np.uint32).astype(np.uint64)
+    ids = np.where((codes >= CHAR_BASE) & (codes <= CHAR_LAST), codes - np.uint64(CHAR_BASE), UNKNOWN_ID)
+
+    keys = np.empty((len(chunk), order), np.uint64)
+    keys[:, 0] = ids
+    for n in range(2, order + 1):
+        keys[n - 1:, n - 1] = (keys[n - 2:-1, n - 2] << CHAR_BITS) | ids[n - 1:]
+        keys[:n - 1, n - 1] = SENTINEL_KEY
+    keys[:, 1:] |= np.arange(1, order, dtype=np.uint64) << LENGTH_SHIFT
+    return keys
+
+
+def valid_keys(keys):
+    """ The mask of the keys of the windows of known chars. """
+    valid = np.ones(keys.shape, bool)
+    for n in range(1, keys.shape[1] + 1):
+        for k in range(n):
+            valid[:, n - 1] &= (keys[:, n - 1] >> (CHAR_BITS * np.uint64(k))) & UNKNOWN_ID != UNKNOWN_ID
+    return valid & (keys != SENTINEL_KEY)
+
+
+class EmissionTable:
+
+    def __init__(self, keys, probs, backoffs, path=None):
+        """ The sorted keys of the windows ending with SENTINEL_KEY, their log probs, and the backoff prob of each
+            window length.
+        """
+        self.keys = keys
+        self.probs = probs
+        self.backoffs = backoffs
+        self.order = len(backoffs)
+        self.path = path
+
+    def __len__(self):
+        return len(self.keys) - 1
+
+    def __getstate__(self):
+        # a loaded table is reloaded from its path, e.g. in worker processes, instead of copying the arrays
+        if self.path:
+            return {'path': self.path}
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        if 'keys' in state:
+            self.__dict__.update(state)
+        else:
+            self.__dict__.update(self.load(state['path']).__dict__)
+
+    @classmethod
+    def compile(cls, lm, texts, order=DEFAULT_ORDER, backoff=None):
+        """ Scores all the windows of the zh char texts, e.g. text_iterator() of a reference corpus, with the
+            cond_probs() of a CachedLM. The backoff prob of the unseen windows is the log prob of an unknown char
+            of the language model if not given.
+        """
+        if backoff is None:
+            # a private use char is never in the vocabulary
+            backoff = lm.cond_probs('\ue000', 1)[0][0]
+
+        keys = [np.array([SENTINEL_KEY])]
+        probs = [np.zeros(1, np.float32)]
+        batch = []
+        chars = 0
+        for text in texts:
+            batch.append(text)
+            chars += len(text)
+            if chars >= BATCH_CHARS:
+                cls._collect(lm, batch, order, keys, probs)
+                batch = []
+                chars = 0
+        cls._collect(lm, batch, order, keys, probs)
+
+        keys, first = np.unique(np.concatenate(keys), return_index=True)
+        return cls(keys, np.concatenate(probs)[first], np.full(order, backoff, np.float64))
+
+    @staticmethod
+    def _collect(lm, texts, order, keys, probs):
+        """ Adds the distinct windows of a batch of texts and their probs to the lists of the windows so far. """
+        batch_keys = []
+        batch_probs = []
+        for text in texts:
+            text_keys = window_keys(text, order)
+            valid = valid_keys(text_keys)
+            batch_keys.append(text_keys[valid])
+            batch_probs.append(np.array(lm.cond_probs(text, order), np.float32).reshape(-1, order)[valid])
+        if not batch_keys:
+            return
+
+        batch_keys, first = np.unique(np.concatenate(batch_keys), return_index=True)
+        keys.append(batch_keys)
+        probs.append(np.concatenate(batch_probs)[first])
+        # merge the batches once they are as many windows as merged before, so the memory is about the distinct
+        # windows, and each window is merged a few times
+        if len(keys) > 1 and sum(map(len, keys[1:])) >= len(keys[0]):
+            merged, first = np.unique(np.concatenate(keys), return_index=True)
+            probs[:] = [np.concatenate(probs)[first]]
+            keys[:] = [merged]
+
+    def cond_probs(self, chunk, order=DEFAULT_ORDER):
+        """ The log probs of the windows of n = 1 ... order chars ending at each char of the chunk, as
+            CachedLM.cond_probs(), but looked up in the table.
+        """
+        return self.batch_cond_probs([chunk], order)[0]
+
+    def batch_cond_probs(self, chunks, order=DEFAULT_ORDER):
+        """ The cond_probs() of each of the chunks, looked up at once, which is much faster for short chunks. """
+        if order > self.order:
+            raise ValueError('The emission table is of windows of at most {} chars'.format(self.order))
+        if len(chunks) == 1:
+            joined = chunks[0]
+            offsets = np.arange(len(joined))
+        else:
+            # the chunks are joined by a char never in the table
+            joined = '\0'.join(chunks)
+            lengths = np.fromiter(map(len, chunks), np.int64, len(chunks)) + 1
+            offsets = np.arange(len(joined)) - np.repeat(np.cumsum(lengths) - lengths, lengths)[:len(joined)]
+
+        keys = window_keys(joined, order)
+        positions = np.searchsorted(self.keys, keys)
+        probs = np.where(self.keys[positions] == keys, self.probs[positions], self.backoffs[:order])
+        # the windows reaching before the start of their chunks
+        probs[offsets[:, None] < np.arange(order)] = IMPOSSIBLE_PROB
+
+        rows = probs.tolist()
+        if len(chunks) == 1:
+            return [rows]
+        results = []
+        start = 0
+        for chunk in chunks:
+            results.append(rows[start:start + len(chunk)])
+            start += len(chunk) + 1
+        return results
+
+    def save(self, table_f):
+        """ Writes the table to a temp file first, then renames it, so it is never left half written. """
+        fd, temp_f = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(table_f)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(TABLE_HEADER.pack(TABLE_MAGIC, TABLE_VERSION, self.order, len(self.keys)))
+                f.write(np.asarray(self.backoffs, '<f8').tobytes())
+                f.write(self.keys.astype('<u8').tobytes())
+                f.write(self.probs.astype('<f4').tobytes())
+            os.replace(temp_f, table_f)
+        except BaseException:
+            os.remove(temp_f)
+            raise
+
+    @classmethod
+    def load(cls, table_f):
+        """ Maps the arrays of a table file into memory. """
+        with open(table_f, 'rb') as f:
+            header = f.read(TABLE_HEADER.size)
+            if len(header) < TABLE_HEADER.size:
+                raise ValueError('Not an emission table file: {}'.format(table_f))
+            magic, version, order, size = TABLE_HEADER.unpack(header)
+            if magic != TABLE_MAGIC:
+                raise ValueError('Not an emission table file: {}'.format(table_f))
+            if version != TABLE_VERSION:
+                raise ValueError('Unsupported emission table version {}: {}'.format(version, table_f))
+            backoffs = np.frombuffer(f.read(8 * order), '<f8').astype(np.float64)
+
+        # plain arrays on the mapped memory, indexed faster than np.memmap
+        offset = TABLE_HEADER.size + 8 * order
+        keys = np.memmap(table_f, '<u8', 'r', offset, (size,)).view(np.ndarray)
+        probs = np.memmap(table_f, '<f4', 'r', offset + 8 * size, (size,)).view(np.ndarray)
+        return cls(keys, probs, backoffs, os.path.abspath(table_f))
@@ -1,6 +1,9 @@
+from collections import deque
 from math import log10
 
 from jiayan.globals import re_zh_include, stopchars
+from jiayan.lm import cached_lm
+from jiayan.parallel import DEFAULT_CHUNKSIZE, imap_batch
 
 """
 Use HMM to consider word detection as a char sequence tagging problem.
@@ -75,11 +78,25 @@ Disadvantages:
           the ngrams dict when filtering.
 """
 
+# the max number of chars whose tags are not decided yet in tokenize_stream(), before the best path decides the oldest
+DEFAULT_LAG = 64
+# the zh chars of a stream are scored in blocks of at most this many chars
+STREAM_BLOCK = 256
+
 
 class CharHMMTokenizer:
 
-    def __init__(self, lm):
-        self.lm = lm
+    def __init__(self, lm=None, emission_table=None):
+        """ The emission probs are computed with the language model, or looked up in the precompiled emission table
+            if given, see EmissionTable, then the language model is not needed. Without either, only decode() works.
+        """
+        self.lm = cached_lm(lm)
+        if isinstance(emission_table, str):
+            # numpy is only imported with an emission table
+            from jiayan.tokenizer.emission_table import EmissionTable
+
+            emission_table = EmissionTable.load(emission_table)
+        self.emission_table = emission_table
         self.inits = {'b': 0.0, 'c': -3.14e100, 'd': -3.14e100, 'e': -3.14e100}
 
         # the transition probabilities are manually fine tuned;
@@ -98,103 +115,210 @@ class CharHMMTokenizer:
         # convert the decimal probabilities to logs to avoid overflow
         self.trans = {states: log10(trans_prob) for states, trans_prob in trans.items()}
 
+        # index the states, so viterbi works on arrays instead of dicts;
+        # for each state, precompute the previous states it can be transited from, with the transition probs
+        self.states = 'bcde'
+        self.init_probs = [self.inits[state] for state in self.states]
+        self.prev_states = [[(prev, self.trans[prev_state + state])
+                             for prev, prev_state in enumerate(self.states)
+                             if prev_state + state in self.trans]
+                            for state in self.states]
+
     def tokenize(self, text: str):
         """ Gets the tags of given sentence, and tokenizes sentence based on the tag sequence.
         """
         # split text by whitespaces first, then split each segment into char chunks by zh chars
-        for seg in text.strip().split():
-            if seg:
-                for chunk in re_zh_include.split(seg):
-                    # if zh chars, tokenize them
-                    if re_zh_include.match(chunk):
-                        tags = self.viterbi(chunk)
-
-                        word = chunk[0]
-                        for i in range(1, len(chunk)):
-                            if tags[i] == 'b':
-                                if not self.valid_word(word):
-                                    for char in word:
-                                        yield char
-                                else:
-                                    yield word
-                                word = chunk[i]
-                            else:
-                                word += chunk[i]
-                        if word:
-                            if not self.valid_word(word):
-                                for char in word:
-                                    yield char
-                            else:
-                                yield word
-
-                    # if not zh chars, we assume they are all punctuations, split them
+        chunks = [chunk for seg in text.strip().split() for chunk in re_zh_include.split(seg)]
+        # the emission probs of all the zh chunks are computed at once
+        emits = iter(self.batch_emission_probs([chunk for chunk in chunks if re_zh_include.match(chunk)]))
+        for chunk in chunks:
+            # if zh chars, tokenize them
+            if re_zh_include.match(chunk):
+                tags = self.decode(next(emits))
+
+                word = chunk[0]
+                for i in range(1, len(chunk)):
+                    if tags[i] == 'b':
+                        if not self.valid_word(word):
+                            for char in word:
+                                yield char
+                        else:
+                            yield word
+                        word = chunk[i]
+                    else:
+                        word += chunk[i]
+                if word:
+                    if not self.valid_word(word):
+                        for char in word:
+                            yield char
                     else:
-                        for char in chunk:
+                        yield word
+
+            # if not zh chars, we assume they are all punctuations, split them
+            else:
+                for char in chunk:
+                    yield char
+
+    def tokenize_stream(self, stream, lag=DEFAULT_LAG):
+        """ Tokenizes a stream of text pieces, e.g. an opened file, a generator of strings or a single string, and
+            yields each word as soon as its tags are decided, instead of decoding a whole zh chunk first.
+
+            The tags are decided by a fixed-lag viterbi, see FixedLagDecoder: once all the surviving paths agree on
+            them, the words are the same as tokenize() of the whole text, else when lag chars are undecided, by the
+            best path so far. A chunk goes on across the pieces, so the memory is bounded by the lag and the scoring
+            block, however long the unpunctuated passages are.
+        """
+        order = len(self.states)
+        decoder = FixedLagDecoder(self, lag)
+        # the undecided chars, and the chars of the word they are part of, of the current zh chunk
+        chars = deque()
+        word = ''
+        # the last chars of the current zh chunk, the windows of the next chars reach into
+        context = ''
+
+        if isinstance(stream, str):
+            stream = [stream]
+        for piece in stream:
+            for run in re_zh_include.split(piece):
+                if not run:
+                    continue
+
+                # if zh chars, decode them in blocks
+                if re_zh_include.match(run):
+                    for start in range(0, len(run), STREAM_BLOCK):
+                        block = run[start:start + STREAM_BLOCK]
+                        emits = self.get_emission_probs(context + block)[len(context):]
+                        context = (context + block)[1 - order:]
+                        chars.extend(block)
+                        for tag in decoder.feed(emits):
+                            char = chars.popleft()
+                            if tag == 'b' and word:
+                                yield from self.word_tokens(word)
+                                word = char
+                            else:
+                                word += char
+
+                # else the zh chunk ends, and the punctuations are split, the whitespaces dropped
+                else:
+                    if chars or word:
+                        yield from self._finish_chunk(decoder, chars, word)
+                        word = ''
+                        context = ''
+                    for char in run:
+                        if not char.isspace():
                             yield char
 
+        if chars or word:
+            yield from self._finish_chunk(decoder, chars, word)
+
+    def _finish_chunk(self, decoder, chars, word):
+        """ Yields the words of the rest of a zh chunk, decided by the best path at its end. """
+        for tag in decoder.finish():
+            char = chars.popleft()
+            if tag == 'b' and word:
+                yield from self.word_tokens(word)
+                word = char
+            else:
+                word += char
+        yield from self.word_tokens(word)
+
+    def word_tokens(self, word):
+        """ The word, or its chars if it is not a valid word. """
+        if not self.valid_word(word):
+            return list(word)
+        return [word]
+
+    def tokenize_batch(self, texts, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+        """ Tokenizes texts with a pool of workers, yields the word lists in order. """
+        return imap_batch(self, 'tokenize', texts, workers, chunksize)
+
     def viterbi(self, sent):
         """ Chooses the most likely char tag sequence of given char sentence.
         """
         emits = self.get_emission_probs(sent)
+        return self.decode(emits)
+
+    def decode(self, emits):
+        """ Runs viterbi over the emission probabilities of a char sequence, returns the best tag sequence.
+
+            Instead of growing whole path strings, we only keep the best path probs to each state of the
+            previous char, and record which previous state the best path comes from in a fixed 4 x N
+            backpointer array, then follow the backpointers from the best last state to recover the tags.
+        """
+        length = len(emits)
+        states = self.states
+        prev_states = self.prev_states
 
-        # record the best path for each state for each char, {path1: path_prob, path2: path_prob, ...};
-        # paths grow at each decoding step, eventually contains the best paths for each state of last char;
         # we assume the initial state probs = 1st char's emission probs
-        paths = {state: prob + self.inits[state] for state, prob in emits[0].items()}
+        probs = [init + emit for init, emit in zip(self.init_probs, emits[0])]
 
-        # for each char
-        for i in range(1, len(sent)):
-            # print(paths)
+        # backs[i * 4 + s] is the best previous state of state s at char i
+        backs = bytearray(len(states) * length)
 
-            # record best paths and their probs to all states of current char
-            cur_char_paths = {}
+        # for each char
+        for i in range(1, length):
+            emit_probs = emits[i]
+            cur_probs = [0.0] * len(states)
+            offset = i * len(states)
 
             # for each state of current char
-            for state, emit_prob in emits[i].items():
-
-                # record all possible paths and their probs to current state
-                cur_state_paths = {}
+            for s, emit_prob in enumerate(emit_probs):
 
-                # for each state of previous char
-                for path, path_prob in paths.items():
-                    trans_states = path[-1] + state
+                # choose the best previous state to current state, on ties the later one wins
+                best_prob = None
+                best_prev = 0
+                for prev, trans_prob in prev_states[s]:
+                    prob = probs[prev] + emit_prob + trans_prob
+                    if best_prob is None or prob >= best_prob:
+                        best_prob = prob
+                        best_prev = prev
 
-                    # compute the path prob from a previous state to current state
-                    if trans_states in self.trans:
-                        cur_state_paths[path + state] = path_prob + emit_prob + self.trans[trans_states]
+                cur_probs[s] = best_prob
+                backs[offset + s] = best_prev
 
-                # choose the best path from all previous paths to current state
-                best_path = sorted(cur_state_paths, key=lambda x: cur_state_paths[x])[-1]
+            probs = cur_probs
 
-                # for current state of current char, we found its best path
-                cur_char_paths[best_path] = cur_state_paths[best_path]
+        # choose the best state of last char, then trace back
+        best = 0
+        for s in range(1, len(states)):
+            if probs[s] >= probs[best]:
+                best = s
 
-            # the paths grow by one char/state
-            paths = cur_char_paths
+        tags = [''] * length
+        for i in range(length - 1, -1, -1):
+            tags[i] = states[best]
+            best = backs[i * len(states) + best]
 
-        return sorted(paths, key=lambda x: paths[x])[-1]
+        return ''.join(tags)
 
     def get_emission_probs(self, sent):
-        """ Computes emission probability of each state emitting relative char in the given char sequence. """
-        return [
-
-            {'b': self.seg_prob(sent[i]),
-             'c': self.seg_prob(sent[i - 1:i + 1]),
-             'd': self.seg_prob(sent[i - 2:i + 1]),
-             'e': self.seg_prob(sent[i - 3:i + 1])
-             }
-
-            for i in range(len(sent))
-        ]
+        """ Computes emission probability of each state emitting relative char in the given char sequence,
+            as a (b, c, d, e) tuple for each char, which are p(ck), p(ck|ck-1), p(ck|ck-2, ck-1) and
+            p(ck|ck-3, ck-2, ck-1).
+        """
+        if self.emission_table is not None:
+            return self.emission_table.cond_probs(sent, len(self.states))
+        self.check_lm()
+        return self.lm.cond_probs(sent, len(self.states))
+
+    def batch_emission_probs(self, sents):
+        """ The emission probs of each of the char sequences, looked up in the emission table at once. """
+        if self.emission_table is not None:
+            return self.emission_table.batch_cond_probs(sents, len(self.states))
+        if sents:
+            self.check_lm()
+        return [self.lm.cond_probs(sent, len(self.states)) for sent in sents]
+
+    def check_lm(self):
+        if self.lm is None:
+            raise ValueError('CharHMMTokenizer needs a language model or an emission table to compute emission probs')
 
     def seg_prob(self, seg):
         """ Computes the segment probability based on ngrams model.
             If given an empty segment, it means it's impossible for current char to be at current position of a word,
             thus return default low log prob -100.
         """
-        return (self.lm.score(' '.join(seg), bos=False, eos=False) -
-                self.lm.score(' '.join(seg[:-1]), bos=False, eos=False)) \
-            or -100.0
+        return (self.lm.seg_score(seg) - self.lm.seg_score(seg[:-1])) or -100.0
     
     def valid_word(self, word):
         """ Checks if a word contains stopchars, if yes, it's not a valid word. """
@@ -204,3 +328,129 @@ class CharHMMTokenizer:
         return True
 
 
+class FixedLagDecoder:
+    """ Viterbi over a char sequence fed a block of emission probs at a time, which decides the tags as early as
+        possible.
+
+        Only the backpointers of the undecided chars are kept. After each char, the paths of the live states are
+        traced back until they meet: all the paths share the tags up to that char, so do the best path at the end
+        whatever follows, and they are decided as the plain viterbi would. If no paths meet in lag chars, the oldest
+        char takes its tag on the best path so far, and the live states off it are dropped, so the later tags stay a
+        valid path.
+    """
+
+    def __init__(self, tokenizer, lag=DEFAULT_LAG):
+        if lag < 1:
+            raise ValueError('The lag of the decoder must be at least 1')
+        self.states = tokenizer.states
+        self.init_probs = tokenizer.init_probs
+        self.prev_states = tokenizer.prev_states
+        self.lag = lag
+        # the best path probs to each state of the last char, None before a chunk
+        self.probs = None
+        self.undecided = 0
+        # backs[k][s] is the best previous state of state s at the (k + 1)th undecided char
+        self.backs = deque()
+
+    def feed(self, emits):
+        """ Decodes the next chars of the emission probs, returns the tags newly decided. """
+        states = self.states
+        prev_states = self.prev_states
+        backs = self.backs
+        tags = []
+
+        for emit_probs in emits:
+            if self.probs is None:
+                self.probs = [init + emit for init, emit in zip(self.init_probs, emit_probs)]
+                self.undecided = 1
+                continue
+
+            probs = self.probs
+            cur_probs = [0.0] * len(states)
+            back = [0] * len(states)
+            for s, emit_prob in enumerate(emit_probs):
+                # on ties the later one wins, as decode()
+                best_prob = None
+                best_prev = 0
+                for prev, trans_prob in prev_states[s]:
+                    prob = probs[prev] + emit_prob + trans_prob
+                    if best_prob is None or prob >= best_prob:
+                        best_prob = prob
+                        best_prev = prev
+                cur_probs[s] = best_prob
+                back[s] = best_prev
+            self.probs = cur_probs
+            # the previous state of the first undecided char is decided
+            if self.undecided:
+                backs.append(back)
+            self.undecided += 1
+
+            # the paths are traced back once a block, or when the undecided chars are too many
+            if self.undecided > self.lag:
+                tags.extend(self._decided())
+                if self.undecided > self.lag:
+                    self._force_oldest()
+                    tags.extend(self._decided())
+
+        if self.undecided:
+            tags.extend(self._decided())
+        return ''.join(tags)
+
+    def finish(self):
+        """ Decides all the undecided tags by the best path at the end of the chunk, and resets the decoder. """
+        if not self.undecided:
+            self.probs = None
+            return ''
+        probs = self.probs
+        best = 0
+        for s in range(1, len(self.states)):
+            if probs[s] >= probs[best]:
+                best = s
+
+        tags = self._trace(best, self.undecided - 1)
+        self.probs = None
+        self.undecided = 0
+        self.backs.clear()
+        return tags
+
+    def _decided(self):
+        """ Pops the tags of the undecided chars up to the last one all the live paths meet at. """
+        live = {s for s, prob in enumerate(self.probs) if prob > float('-inf')}
+        position = len(self.backs)
+        while len(live) > 1 and position > 0:
+            position -= 1
+            live = {self.backs[position][s] for s in live}
+        if len(live) > 1:
+            return ''
+
+        tags = self._trace(live.pop(), position)
+        self.undecided -= position + 1
+        # the backpointers of the next undecided char are not needed either, its previous state is decided
+        for _ in range(min(position + 1, len(self.backs))):
+            self.backs.popleft()
+        return tags
+
+    def _force_oldest(self):
+        """ Decides the oldest undecided char by the best path so far, and drops the live states off it. """
+        probs = self.probs
+        best = 0
+        for s in range(1, len(self.states)):
+            if probs[s] >= probs[best]:
+                best = s
+
+        # the state of the oldest char on the path of each state of the last char
+        oldest = list(range(len(self.states)))
+        for back in reversed(self.backs):
+            oldest = [back[s] for s in oldest]
+        for s in range(len(self.states)):
+            if oldest[s] != oldest[best]:
+                probs[s] = float('-inf')
+
+    def _trace(self, state, position):
+        """ The tags of the undecided chars up to the char at position, whose state is given. """
+        tags = [''] * (position + 1)
+        for k in range(position, -1, -1):
+            tags[k] = self.states[state]
+            if k:
+                state = self.backs[k - 1][state]
+        return ''.join(tags)
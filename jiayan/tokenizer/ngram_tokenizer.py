@@ -1,49 +1,298 @@
 import os
-import marshal
-from math import log
+import mmap
+import struct
+import hashlib
+import tempfile
+from math import exp, log
 
 from jiayan.globals import re_zh_include
+from jiayan.parallel import DEFAULT_CHUNKSIZE, imap_batch
+from jiayan.tokenizer.prefix_index import NO_WORD, AhoCorasickAutomaton, DictPrefixIndex, DoubleArrayTrie
 
 """
 References:
 [https://github.com/fxsjy/jieba]
 """
 
-dir_path = os.path.dirname(os.path.realpath(__file__))
 root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
 dict_path = os.path.join(root, 'data/dict.txt')
-cache_path = os.path.join(dir_path, 'tokenizer.cache')
+
+indexes = {
+    'dict': DictPrefixIndex,
+    'trie': DoubleArrayTrie,
+    'automaton': AhoCorasickAutomaton,
+}
+
+# the cache header: magic, format version, and the mtime, size and sha1 of the dict file it is built from
+CACHE_HEADER = struct.Struct('<8sIqq20s')
+CACHE_MAGIC = b'JIAYANDC'
+CACHE_VERSION = 3
+
+# the first line of the user dict overlay, with the sha1 of the dict file it is made on
+OVERLAY_HEADER = '#jiayan userdict {}\n'
+# the user dict overlay is compacted when it has this many times more lines than words
+OVERLAY_COMPACT_RATIO = 2
+
+
+def default_cache_dir():
+    """ The cache dir is $JIAYAN_CACHE_DIR if set, or jiayan in the user cache dir. """
+    cache_dir = os.environ.get('JIAYAN_CACHE_DIR')
+    if not cache_dir:
+        user_cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        cache_dir = os.path.join(user_cache_dir, 'jiayan')
+    return cache_dir
+
+
+def file_digest(file):
+    sha1 = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.digest()
 
 
 class WordNgramTokenizer:
 
-    def __init__(self, dict_f=None):
-        if not dict_f:
-            dict_f = dict_path
-        self.cache = cache_path
-        self.PREFIX, self.total = self.check_cache(dict_f)
+    def __init__(self, dict_f=None, index='dict', cache_dir=None):
+        """ The index to look up dict words could be
+                "dict": the prefix dict;
+                "trie": the double-array trie, compact for big dicts, and loaded from cache in no time;
+                "automaton": the Aho-Corasick automaton on the trie, which finds all the words in one pass.
+            All give the same tokens.
+            The index is cached in cache_dir, see default_cache_dir(), one cache for each dict file and index type.
+            The user words of add_word(), del_word() and load_userdict() are kept in an overlay of the index, and
+            appended to an overlay file in cache_dir, one for each dict file, so they persist across processes: every
+            later tokenizer of the dict file with the same cache_dir, in this or another program, loads them again,
+            until clear_userdict() or clear_cache(). The overlay is dropped when the dict file changes.
+        """
+        if index not in indexes:
+            raise ValueError('Unknown index type: {}'.format(index))
+        self.dict_f = os.path.abspath(dict_f or dict_path)
+        self.index_type = index
+        self.cache_dir = cache_dir
+
+        dict_key = hashlib.sha1(self.dict_f.encode('utf-8')).hexdigest()[:16]
+        self.cache = os.path.join(cache_dir or default_cache_dir(), 'tokenizer.{}.{}.cache'.format(index, dict_key))
+        self.overlay = os.path.join(cache_dir or default_cache_dir(), 'tokenizer.{}.userdict'.format(dict_key))
+
+        # the sha1 of the dict file, from the cache header or computed with the cache
+        self.dict_digest = None
+        self.index = self.check_cache(self.dict_f)
+        self.total = self.index.total
+        self.log_total = log(self.total)
+        if index == 'dict':
+            self.PREFIX = self.index.PREFIX
+
+        # the freqs of the user words, 0 of the deleted words, and the prefix dict of their log freqs, NO_WORD of the
+        # deleted words, None of the other prefixes
+        self.user_words = {}
+        self.USER_PREFIX = {}
+        self.load_overlay()
+
+    def __getstate__(self):
+        # the index is reloaded from the cache instead of being pickled, e.g. in worker processes
+        return {'dict_f': self.dict_f, 'index': self.index_type, 'cache_dir': self.cache_dir,
+                'user_words': self.user_words}
+
+    def __setstate__(self, state):
+        self.__init__(state['dict_f'], state['index'], state['cache_dir'])
+        # the user words not in the overlay file, if it is not writable
+        for word, freq in state.get('user_words', {}).items():
+            self.set_word(word, freq)
 
     def check_cache(self, dict_f):
-        """ Loads frequency dict and total word counts from cache.
+        """ Loads the dict index from cache, if the cache is built from current dict file,
+            otherwise builds the index and dumps the cache.
+        """
+        stat = os.stat(dict_f)
+        index = self.load_cache(dict_f, stat)
+        if index is None:
+            index = self.build_index(dict_f)
+            self.dump_cache(index, dict_f, stat)
+        return index
+
+    def build_index(self, dict_f):
+        if self.index_type != 'dict':
+            return indexes[self.index_type].from_word_counts(self.read_dict(dict_f))
+        return DictPrefixIndex.from_prefix_counts(*self.gen_prefix_dict(dict_f))
+
+    def load_cache(self, dict_f, stat):
+        """ Maps the cache file into memory and loads the index from it, returns None if the cache is missing,
+            of another format version, or built from another version of the dict file.
+        """
+        try:
+            with open(self.cache, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        if len(buffer) < CACHE_HEADER.size:
+            return None
+        magic, version, mtime, size, digest = CACHE_HEADER.unpack_from(buffer)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION or size != stat.st_size:
+            return None
+        if mtime != stat.st_mtime_ns:
+            # the dict file may be touched or copied without changes, then the cache gets the new mtime, so the dict
+            # file is not hashed again on every load
+            if digest != file_digest(dict_f):
+                return None
+            body = buffer[CACHE_HEADER.size:]
+            self.write_cache(stat, digest, lambda f: f.write(body))
+
+        self.dict_digest = digest
+        return indexes[self.index_type].load(buffer, CACHE_HEADER.size)
+
+    def dump_cache(self, index, dict_f, stat):
+        self.write_cache(stat, file_digest(dict_f), index.dump)
+
+    def write_cache(self, stat, digest, dump):
+        """ Writes the cache header of the dict file and the body of dump(file) to a temp file and renames it, so
+            other processes never read a partial cache. If the cache dir is not writable, goes on without cache.
+        """
+        self.dict_digest = digest
+        cache_dir = os.path.dirname(self.cache)
+        temp_cache = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, temp_cache = tempfile.mkstemp(dir=cache_dir, prefix='tokenizer.', suffix='.tmp')
+            with os.fdopen(fd, 'wb') as temp_cache_file:
+                temp_cache_file.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, stat.st_mtime_ns, stat.st_size,
+                                                        digest))
+                dump(temp_cache_file)
+            # mkstemp makes files only readable by the owner
+            os.chmod(temp_cache, 0o644)
+            os.replace(temp_cache, self.cache)
+        except OSError:
+            if temp_cache and os.path.exists(temp_cache):
+                os.remove(temp_cache)
+
+    def clear_cache(self, userdict=True):
+        """ Removes the cache of the index, and the user words too if userdict, so the next tokenizer of the dict file
+            has only the words of the dict file.
         """
-        if os.path.isfile(self.cache):
-            with open(self.cache, 'rb') as cf:
-                return marshal.load(cf)
-        else:
-            # if no cache, generate freq dict and dump the cache
-            PREFIX, total = self.gen_prefix_dict(dict_f)
-            with open(self.cache, 'wb') as temp_cache_file:
-                marshal.dump((PREFIX, total), temp_cache_file)
-            return PREFIX, total
-
-    def clear_cache(self):
         if os.path.isfile(self.cache):
             os.remove(self.cache)
+        if userdict:
+            self.clear_userdict()
+
+    def add_word(self, word, freq):
+        """ Adds a word to the dict, or changes its freq, in O(len(word)), and appends it to the overlay file, so the
+            later tokenizers of the dict file have it too.
+        """
+        if freq < 0:
+            raise ValueError('The freq of a word must not be negative: {}'.format(freq))
+        self.set_word(word, int(freq))
+        self.append_overlay({word: int(freq)})
+
+    def del_word(self, word):
+        """ Deletes a word from the dict, as a word of freq 0. """
+        self.add_word(word, 0)
+
+    def load_userdict(self, dict_f):
+        """ Adds the words of a dict file of "word,freq" lines, see read_dict(). """
+        word_counts = self.read_dict(dict_f)
+        for word, freq in word_counts.items():
+            self.set_word(word, freq)
+        self.append_overlay(word_counts)
+
+    def clear_userdict(self):
+        """ Drops all the user words, and removes the overlay file. """
+        self.user_words = {}
+        self.USER_PREFIX = {}
+        self.total = self.index.total
+        self.log_total = log(self.total)
+        if os.path.isfile(self.overlay):
+            os.remove(self.overlay)
+
+    def word_freq(self, word):
+        """ The freq of a word in the dict with the user words, 0 if not in it. """
+        if word in self.user_words:
+            return self.user_words[word]
+        for end, log_freq in self.index.words_from(word, 0):
+            if end == len(word) - 1:
+                # the freqs are ints, exactly recovered from their logs
+                return round(exp(log_freq))
+        return 0
+
+    def set_word(self, word, freq):
+        """ Sets the freq of a word in the overlay of the index, and updates the total, without writing the overlay
+            file.
+        """
+        self.total += freq - self.word_freq(word)
+        self.log_total = log(self.total)
+        self.user_words[word] = freq
+
+        USER_PREFIX = self.USER_PREFIX
+        for i in range(1, len(word)):
+            USER_PREFIX.setdefault(word[:i], None)
+        USER_PREFIX[word] = log(freq) if freq else NO_WORD
+
+    def load_overlay(self):
+        """ Sets the user words of the overlay file, the last freq of each word, and compacts the file if it has
+            many more lines than words. A line not fully written is skipped, and dropped by compacting the file.
+            The overlay file made on another version of the dict file is removed.
+        """
+        try:
+            with open(self.overlay, 'rb') as f:
+                lines = f.read().decode('utf-8').splitlines(keepends=True)
+        except (OSError, UnicodeDecodeError):
+            return
+
+        if not lines or lines[0] != self.overlay_header():
+            try:
+                os.remove(self.overlay)
+            except OSError:
+                pass
+            return
+
+        lines = lines[1:]
+        word_counts = {}
+        valid = 0
+        for line in lines:
+            word, _, freq = line.strip().rpartition(',')
+            if word and freq.isdigit():
+                word_counts[word] = int(freq)
+                valid += 1
+        for word, freq in word_counts.items():
+            self.set_word(word, freq)
+
+        if valid < len(lines) or len(lines) > OVERLAY_COMPACT_RATIO * len(word_counts):
+            self.write_overlay(word_counts)
+
+    def append_overlay(self, word_counts):
+        """ Appends the words to the overlay file. If the cache dir is not writable, the words are only kept in
+            memory.
+        """
+        try:
+            os.makedirs(os.path.dirname(self.overlay), exist_ok=True)
+            with open(self.overlay, 'ab') as f:
+                if not f.tell():
+                    f.write(self.overlay_header().encode('utf-8'))
+                f.write(''.join('{},{}\n'.format(word, freq) for word, freq in word_counts.items()).encode('utf-8'))
+        except OSError:
+            pass
+
+    def write_overlay(self, word_counts):
+        """ Writes the overlay file to a temp file and renames it, as dump_cache(). """
+        temp_overlay = None
+        try:
+            fd, temp_overlay = tempfile.mkstemp(dir=os.path.dirname(self.overlay), prefix='tokenizer.', suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.overlay_header().encode('utf-8'))
+                f.write(''.join('{},{}\n'.format(word, freq) for word, freq in word_counts.items()).encode('utf-8'))
+            os.chmod(temp_overlay, 0o644)
+            os.replace(temp_overlay, self.overlay)
+        except OSError:
+            if temp_overlay and os.path.exists(temp_overlay):
+                os.remove(temp_overlay)
+
+    def overlay_header(self):
+        return OVERLAY_HEADER.format(self.dict_digest.hex())
 
     @staticmethod
-    def gen_prefix_dict(dict_f):
-        """ Reads a dict file and generates the prefix dictionary with total word counts.
+    def read_dict(dict_f):
+        """ Reads a dict file of "word,freq" lines.
         """
         word_counts = {}
         with open(dict_f, 'rb') as f:
@@ -51,14 +300,23 @@ class WordNgramTokenizer:
                 line = line.strip().decode('utf-8')
                 word, freq = line.split(',')
                 word_counts[word] = int(freq)
+        return word_counts
 
-                # enumerate all prefixes of a word to enrich the vocab
-                for i in range(len(word)):
-                    prefix = word[:i + 1]
-                    if prefix not in word_counts:
-                        word_counts[prefix] = 0
+    @classmethod
+    def gen_prefix_dict(cls, dict_f):
+        """ Reads a dict file and generates the prefix dictionary with total word counts.
+        """
+        word_counts = cls.read_dict(dict_f)
+        total = sum(word_counts.values())
 
-        return word_counts, sum(word_counts.values())
+        # enumerate all prefixes of a word to enrich the vocab
+        for word in list(word_counts):
+            for i in range(len(word)):
+                prefix = word[:i + 1]
+                if prefix not in word_counts:
+                    word_counts[prefix] = 0
+
+        return word_counts, total
 
     def tokenize(self, text):
         # split zh chars and non-zh chars into chunks
@@ -74,69 +332,104 @@ class WordNgramTokenizer:
                 else:
                     yield chk
 
+    def tokenize_batch(self, texts, workers=None, chunksize=DEFAULT_CHUNKSIZE):
+        """ Tokenizes texts with a pool of workers, yields the word lists in order. """
+        return imap_batch(self, 'tokenize', texts, workers, chunksize)
+
     def cut_DAG(self, sentence):
         """ Cuts the DAG according to max route probabilities.
         """
         DAG = self.gen_DAG(sentence)
-        route = {}
-        self.calculate_route_prob(sentence, DAG, route)
+        route = self.calculate_route_prob(sentence, DAG)
 
         start = 0
         N = len(sentence)
 
         while start < N:
-            end = route[start][1]
+            end = route[start]
             word = sentence[start:end + 1]
             yield word
             start = end + 1
 
     def gen_DAG(self, sentence):
-        """ Generates DAG based on given sentence and prefix dict.
+        """ Generates DAG based on given sentence and the dict index, as flat lists of the (end, log freq) of the
+            words starting from each position: the words from position i are ends[k] and weights[k] for k in
+            range(offsets[i], offsets[i + 1]), in the order of their ends.
         """
-        DAG = {}
+        # the freq of an OOV char is 0, we assume each word appears at least once,
+        # like add-1 laplace smoothing
+        if not self.user_words:
+            return self.index.gen_DAG(sentence, log(1))
+
+        # the OOV chars of the index are marked None, the user words may be there
+        offsets, ends, weights = self.index.gen_DAG(sentence, None)
+        USER_PREFIX = self.USER_PREFIX
         N = len(sentence)
+        user_offsets = [0] * (N + 1)
+        user_ends = []
+        user_weights = []
 
         for start in range(N):
-            ends = []
-            end = start
-            prefix = sentence[start]
-            while end < N and prefix in self.PREFIX:
-                if self.PREFIX[prefix]:
-                    ends.append(end)
-                end += 1
+            if sentence[start] not in USER_PREFIX:
+                for k in range(offsets[start], offsets[start + 1]):
+                    if weights[k] is not None:
+                        user_ends.append(ends[k])
+                        user_weights.append(weights[k])
+            else:
+                words = {ends[k]: weights[k] for k in range(offsets[start], offsets[start + 1])
+                         if weights[k] is not None}
+                end = start
+                prefix = sentence[start]
+                while end < N and prefix in USER_PREFIX:
+                    log_freq = USER_PREFIX[prefix]
+                    if log_freq == NO_WORD:
+                        words.pop(end, None)
+                    elif log_freq is not None:
+                        words[end] = log_freq
+                    end += 1
+                    prefix = sentence[start:end + 1]
+                for end in sorted(words):
+                    user_ends.append(end)
+                    user_weights.append(words[end])
 
-                # extend prefix
-                prefix = sentence[start:end + 1]
+            if len(user_ends) == user_offsets[start]:
+                user_ends.append(start)
+                user_weights.append(log(1))
+            user_offsets[start + 1] = len(user_ends)
 
-            # if no words formed starting from current char, OOV, it ends with itself
-            if not ends:
-                ends.append(start)
+        return user_offsets, user_ends, user_weights
 
-            DAG[start] = ends
-
-        return DAG
-
-    def calculate_route_prob(self, sentence, DAG, route):
-        """ Uses dynamic programming to compute the tokenizing solution with highest probability.
+    def calculate_route_prob(self, sentence, DAG):
+        """ Uses dynamic programming to compute the tokenizing solution with highest probability, returns the
+            route, the list of the end of the first word of the best path from each position.
         """
         N = len(sentence)
+        offsets, ends, weights = DAG
+        log_total = self.log_total
 
-        # each position in the route will be stored as "position: (prob, end)", where the value
-        # tuple contains the highest path prob to current position, and the most recent word
-        # ending position from current route position;
+        # the highest path prob from each position to the sentence end, and the end of its first word;
         # in other words, sentence[position: end + 1] forms the word and together with which
         # the rest of the path that makes the tokenizing solution with highest probability
-        route[N] = (0, 0)
-        log_total = log(self.total)
+        path_probs = [0.0] * (N + 1)
+        route = [0] * N
 
         # compute from backwards to forwards, because ...
         for i in range(N - 1, -1, -1):
 
             # for each word start position, lists all its possible word ending positions,
-            # compute their word probabilities, and add relative rest path probabilities,
-            # then choose the end position that makes the whole path probability highest
+            # add their word probabilities, log freq - log total, and relative rest path probabilities,
+            # then choose the end position that makes the whole path probability highest,
+            # on ties the longer word wins
+            best_prob = None
+            best_end = i
+            for k in range(offsets[i], offsets[i + 1]):
+                end = ends[k]
+                prob = weights[k] - log_total + path_probs[end + 1]
+                if best_prob is None or prob >= best_prob:
+                    best_prob = prob
+                    best_end = end
+
+            path_probs[i] = best_prob
+            route[i] = best_end
 
-            # the value got from PREFIX dict could be either None or 0, we assume each word
-            # appears at least once, like add-1 laplace smoothing
-            route[i] = max((log(self.PREFIX.get(sentence[i:end + 1]) or 1) - log_total
-                            + route[end + 1][0], end) for end in DAG[i])
+        return route
@@ -0,0 +1,428 @@
+import marshal
+import struct
+from array import array
+from bisect import bisect_left
+from collections import Counter, deque
+from math import log
+
+"""
+Prefix indexes of the word dict for WordNgramTokenizer, which find all the dict words starting at a position of a
+sentence, in one walk from the position.
+
+DictPrefixIndex is the classic jieba style prefix dict, all words and all their prefixes are dict keys, so each
+step of the walk looks up a new sliced string.
+
+DoubleArrayTrie stores the trie of the words in 3 flat arrays, a walk step is 2 array reads, without slicing
+strings, and it takes a fraction of the memory of the prefix dict for big dicts.
+(see Double-Array Trie: [https://linux.thai.net/~thep/datrie/datrie.html])
+
+AhoCorasickAutomaton adds the failure links of the Aho-Corasick algorithm to the trie, and finds all the dict words
+of a sentence in one left-to-right pass, instead of a walk from each position, without the prefixes of the words.
+(see Aho-Corasick: [https://en.wikipedia.org/wiki/Aho%E2%80%93Corasick_algorithm])
+
+All keep the log freq of each word instead of its freq, computed once when the index is built, so tokenizing does
+not call log() for each candidate word. The log probs log(freq) - log(total) are left to the tokenizer, so the total
+could change without touching the log freqs of all the words.
+
+All could be dumped to and loaded from a cache file, the trie arrays are used in place from a memory-mapped cache,
+so loading it costs nearly nothing, and worker processes share the same pages.
+"""
+
+# if a node tries more free positions than this to find its base, the later nodes start searching further
+MAX_BASE_TRIES = 64
+
+# the log freq of the trie nodes no word ends at, log freqs are never negative
+NO_WORD = -1.0
+
+
+def to_log_freqs(word_counts):
+    """ The log freqs of the words of positive freqs. """
+    return {word: log(freq) for word, freq in word_counts.items() if freq}
+
+
+class DictPrefixIndex:
+
+    def __init__(self, prefix_dict, total):
+        """ The prefix dict maps the words to their log freqs, and the other prefixes of the words to None. """
+        self.PREFIX = prefix_dict
+        self.total = total
+
+    @classmethod
+    def from_prefix_counts(cls, prefix_counts, total):
+        """ The index of a jieba style prefix dict of the freqs of the words, and 0 of the other prefixes. """
+        prefix_dict = dict.fromkeys(prefix_counts)
+        prefix_dict.update(to_log_freqs(prefix_counts))
+        return cls(prefix_dict, total)
+
+    def dump(self, f):
+        marshal.dump((self.PREFIX, self.total), f)
+
+    @classmethod
+    def load(cls, buffer, offset):
+        return cls(*marshal.loads(buffer[offset:]))
+
+    def gen_DAG(self, sentence, oov_weight):
+        """ The flat lists of the DAG of the sentence, see WordNgramTokenizer.gen_DAG(), the walks of all the
+            positions in one loop.
+        """
+        PREFIX = self.PREFIX
+        N = len(sentence)
+        offsets = [0] * (N + 1)
+        ends = []
+        weights = []
+
+        for start in range(N):
+            end = start
+            prefix = sentence[start]
+            while end < N and prefix in PREFIX:
+                log_freq = PREFIX[prefix]
+                if log_freq is not None:
+                    ends.append(end)
+                    weights.append(log_freq)
+                end += 1
+                prefix = sentence[start:end + 1]
+
+            # if no words formed starting from current char, OOV, it ends with itself
+            if len(ends) == offsets[start]:
+                ends.append(start)
+                weights.append(oov_weight)
+            offsets[start + 1] = len(ends)
+
+        return offsets, ends, weights
+
+    def words_from(self, sentence, start):
+        """ Yields (end, log freq) of each word sentence[start: end + 1] in the dict. """
+        PREFIX = self.PREFIX
+        N = len(sentence)
+        end = start
+        prefix = sentence[start]
+        while end < N and prefix in PREFIX:
+            log_freq = PREFIX[prefix]
+            if log_freq is not None:
+                yield end, log_freq
+            end += 1
+
+            # extend prefix
+            prefix = sentence[start:end + 1]
+
+
+class DoubleArrayTrie:
+    """ A trie whose node s goes to its child node t = base[s] + code[char] if check[t] == s, and the word ends at
+        node t has log freq log_freqs[t], NO_WORD if no word ends there. The root is node 0.
+    """
+
+    # total, number of chars, number of array slots
+    HEADER = struct.Struct('<qqq')
+    NUM_EXTRA_ARRAYS = 0
+
+    def __init__(self, codes, base, check, log_freqs, total):
+        self.codes = codes
+        self.base = base
+        self.check = check
+        self.log_freqs = log_freqs
+        self.total = total
+
+    @classmethod
+    def from_word_counts(cls, word_counts):
+        # the more frequent a char is, the smaller its code, so the dense top of the trie packs well
+        char_counts = Counter()
+        for word, freq in word_counts.items():
+            if freq:
+                char_counts.update(word)
+        codes = {char: code + 1 for code, (char, _) in enumerate(char_counts.most_common())}
+        base, check, log_freqs = cls.build(to_log_freqs(word_counts), codes)
+        return cls(codes, base, check, log_freqs, sum(word_counts.values()))
+
+    def dump(self, f):
+        """ Writes the log freqs as 8-byte floats first, so they stay aligned, then the chars in code order and the
+            other 2 arrays as 4-byte ints.
+        """
+        chars = array('i', [0]) * (len(self.codes) + 1)
+        for char, code in self.codes.items():
+            chars[code] = ord(char)
+        f.write(self.HEADER.pack(self.total, len(chars), len(self.base)))
+        for arr in (self.log_freqs, chars, self.base, self.check) + self.extra_arrays():
+            f.write(arr.tobytes())
+
+    def extra_arrays(self):
+        """ The other int arrays of the size of the trie arrays, dumped after them, and given to the constructor after
+            the total when loaded.
+        """
+        return ()
+
+    @classmethod
+    def load(cls, buffer, offset):
+        """ Loads the trie from a buffer like a memory-mapped file, the arrays are views of it without copying. """
+        total, num_chars, size = cls.HEADER.unpack_from(buffer, offset)
+        view = memoryview(buffer)
+        offset += cls.HEADER.size
+
+        arrays = []
+        for typecode, length in (('d', size), ('i', num_chars)) + (('i', size),) * (2 + cls.NUM_EXTRA_ARRAYS):
+            itemsize = array(typecode).itemsize
+            arrays.append(view[offset: offset + itemsize * length].cast(typecode))
+            offset += itemsize * length
+        log_freqs, chars, base, check = arrays[:4]
+
+        codes = {chr(chars[code]): code for code in range(1, num_chars)}
+        return cls(codes, base, check, log_freqs, total, *arrays[4:])
+
+    @staticmethod
+    def build(word_log_freqs, codes):
+        """ Places the trie nodes breadth first, each node gets the smallest base that all its children fit in. """
+        words = sorted(word_log_freqs)
+        max_code = len(codes)
+
+        size = max(1024, 2 * len(words))
+        base = array('i', [0]) * size
+        check = array('i', [-1]) * size
+        log_freqs = array('d', [NO_WORD]) * size
+        check[0] = 0
+        last = 0
+
+        # free_from[p] leads to the first free position from p, as a union-find with path halving,
+        # so taken positions are skipped at once when searching bases
+        free_from = array('i', range(size))
+        free_from[0] = 1
+        next_pos = 1
+
+        def find_free(pos):
+            while free_from[pos] != pos:
+                free_from[pos] = free_from[free_from[pos]]
+                pos = free_from[pos]
+            return pos
+
+        # nodes to place, each owns the words[lo: hi] sharing the prefix of length depth
+        queue = deque([(0, 0, len(words), 0)])
+        while queue:
+            node, lo, hi, depth = queue.popleft()
+
+            # the word ending at current node sorts first
+            if len(words[lo]) == depth:
+                log_freqs[node] = word_log_freqs[words[lo]]
+                lo += 1
+
+            children = []
+            while lo < hi:
+                prefix = words[lo][:depth + 1]
+                end = bisect_left(words, prefix + '\U0010FFFF', lo, hi)
+                children.append((codes[prefix[-1]], lo, end))
+                lo = end
+            if not children:
+                continue
+
+            # the first child takes a free position, then check if the others fit
+            first_code = children[0][0]
+            start = max(first_code + 1, next_pos)
+            pos = find_free(start)
+            tries = 0
+            while True:
+                b = pos - first_code
+                if b + max_code + 1 >= size:
+                    extra = size
+                    base.extend(array('i', [0]) * extra)
+                    check.extend(array('i', [-1]) * extra)
+                    log_freqs.extend(array('d', [NO_WORD]) * extra)
+                    free_from.extend(array('i', range(size, size + extra)))
+                    size += extra
+
+                if all(check[b + code] == -1 for code, _, _ in children):
+                    break
+                tries += 1
+                pos = find_free(pos + 1)
+
+            # if it took many tries, the holes from where we started are hard to fill,
+            # start the later searches further
+            if tries >= MAX_BASE_TRIES:
+                next_pos = find_free((start + pos) // 2)
+
+            base[node] = b
+            for code, child_lo, child_hi in children:
+                child = b + code
+                check[child] = node
+                free_from[child] = child + 1
+                last = max(last, child)
+                queue.append((child, child_lo, child_hi, depth + 1))
+
+        # keep enough room after the last node, so a child position never runs out of the arrays
+        size = last + max_code + 1
+        return base[:size], check[:size], log_freqs[:size]
+
+    def gen_DAG(self, sentence, oov_weight):
+        """ The flat lists of the DAG of the sentence, see WordNgramTokenizer.gen_DAG(), the walks of all the
+            positions in one loop.
+        """
+        base = self.base
+        check = self.check
+        log_freqs = self.log_freqs
+        # the codes of the chars, 0 for the chars not in the trie
+        codes = [self.codes.get(char, 0) for char in sentence]
+        N = len(sentence)
+        offsets = [0] * (N + 1)
+        dag_ends = []
+        dag_weights = []
+
+        for start in range(N):
+            node = 0
+            for end in range(start, N):
+                code = codes[end]
+                if not code:
+                    break
+                child = base[node] + code
+                if check[child] != node:
+                    break
+                node = child
+                log_freq = log_freqs[node]
+                if log_freq != NO_WORD:
+                    dag_ends.append(end)
+                    dag_weights.append(log_freq)
+
+            # if no words formed starting from current char, OOV, it ends with itself
+            if len(dag_ends) == offsets[start]:
+                dag_ends.append(start)
+                dag_weights.append(oov_weight)
+            offsets[start + 1] = len(dag_ends)
+
+        return offsets, dag_ends, dag_weights
+
+    def words_from(self, sentence, start):
+        """ Yields (end, log freq) of each word sentence[start: end + 1] in the trie. """
+        base = self.base
+        check = self.check
+        log_freqs = self.log_freqs
+        codes = self.codes
+
+        node = 0
+        for end in range(start, len(sentence)):
+            code = codes.get(sentence[end])
+            if code is None:
+                return
+            child = base[node] + code
+            if check[child] != node:
+                return
+            node = child
+            log_freq = log_freqs[node]
+            if log_freq != NO_WORD:
+                yield end, log_freq
+
+
+class AhoCorasickAutomaton(DoubleArrayTrie):
+    """ The double-array trie of the words, with the failure link fail[s] of each node s, the node of the longest
+        proper suffix of the string of s in the trie, and the output link links[s], the node of the longest proper
+        suffix of it that is a word, 0 if none. depths[s] is the length of the string of s.
+    """
+
+    NUM_EXTRA_ARRAYS = 3
+
+    def __init__(self, codes, base, check, log_freqs, total, fail, links, depths):
+        super().__init__(codes, base, check, log_freqs, total)
+        self.fail = fail
+        self.links = links
+        self.depths = depths
+
+    @classmethod
+    def from_word_counts(cls, word_counts):
+        trie = DoubleArrayTrie.from_word_counts(word_counts)
+        fail, links, depths = cls.build_links(trie.base, trie.check, trie.log_freqs)
+        return cls(trie.codes, trie.base, trie.check, trie.log_freqs, trie.total, fail, links, depths)
+
+    def extra_arrays(self):
+        return self.fail, self.links, self.depths
+
+    @staticmethod
+    def build_links(base, check, log_freqs):
+        """ Links the nodes breadth first, so the links of the shorter strings are there before the longer ones. """
+        size = len(base)
+        children = [[] for _ in range(size)]
+        for node in range(1, size):
+            if check[node] >= 0:
+                children[check[node]].append(node)
+
+        fail = array('i', [0]) * size
+        links = array('i', [0]) * size
+        depths = array('i', [0]) * size
+
+        queue = deque([0])
+        while queue:
+            node = queue.popleft()
+            for child in children[node]:
+                depths[child] = depths[node] + 1
+                queue.append(child)
+                if not node:
+                    continue
+
+                # the longest suffix of the parent with a child of the same char
+                code = child - base[node]
+                suffix = fail[node]
+                while True:
+                    target = base[suffix] + code
+                    if check[target] == suffix:
+                        fail[child] = target
+                        break
+                    if not suffix:
+                        break
+                    suffix = fail[suffix]
+                links[child] = fail[child] if log_freqs[fail[child]] != NO_WORD else links[fail[child]]
+
+        return fail, links, depths
+
+    def gen_DAG(self, sentence, oov_weight):
+        """ The flat lists of the DAG of the sentence, see WordNgramTokenizer.gen_DAG(), of the (start, end, log freq)
+            of all the words found in one pass, then grouped by their starts.
+        """
+        base = self.base
+        check = self.check
+        log_freqs = self.log_freqs
+        fail = self.fail
+        links = self.links
+        depths = self.depths
+        N = len(sentence)
+
+        # the words are found in the order of their ends, and of their starts backwards for the same end
+        match_starts = []
+        match_ends = []
+        match_weights = []
+        counts = [0] * N
+
+        node = 0
+        for end, code in enumerate([self.codes.get(char, 0) for char in sentence]):
+            if not code:
+                node = 0
+                continue
+            while True:
+                child = base[node] + code
+                if check[child] == node:
+                    node = child
+                    break
+                if not node:
+                    break
+                node = fail[node]
+
+            word = node if log_freqs[node] != NO_WORD else links[node]
+            while word:
+                start = end - depths[word] + 1
+                match_starts.append(start)
+                match_ends.append(end)
+                match_weights.append(log_freqs[word])
+                counts[start] += 1
+                word = links[word]
+
+        # if no words formed starting from a char, OOV, it ends with itself
+        offsets = [0] * (N + 1)
+        for start in range(N):
+            offsets[start + 1] = offsets[start] + (counts[start] or 1)
+        dag_ends = [0] * offsets[N]
+        dag_weights = [oov_weight] * offsets[N]
+        for start in range(N):
+            if not counts[start]:
+                dag_ends[offsets[start]] = start
+
+        # each word goes to the next slot of its start, so the words of a start stay in the order of their ends
+        slots = offsets[:N]
+        for start, end, log_freq in zip(match_starts, match_ends, match_weights):
+            slot = slots[start]
+            dag_ends[slot] = end
+            dag_weights[slot] = log_freq
+            slots[start] = slot + 1
+
+        return offsets, dag_ends, dag_weights
@@ -0,0 +1,180 @@
+import os
+import pickle
+import tempfile
+import zlib
+from itertools import islice
+
+from jiayan.parallel import imap_batch
+
+"""
+Streaming training of the CRF taggers.
+
+The features of a whole training corpus, as lists of feature strings, take many times the memory of the corpus, so
+instead of building them into lists, iter_data() of a tagger yields the (features, tags) examples of a corpus file
+one by one, and each example goes either straight into the crfsuite trainer, or into a temp file of the held-out
+examples, read back one by one to evaluate the trained model. The memory of the python side does not grow with the
+corpus, only crfsuite keeps its own compact copy of the training examples.
+
+An example is held out by a hash of its id, its position in the corpus, so the split is the same in every run, and
+the same however the examples are read, e.g. by build_data() and split_data().
+
+The examples are made from batches of lines by batch_examples() of the tagger, which could be run by a pool of worker
+processes, each with its own copy of the tagger and its models, and the examples come back in the order of the lines,
+so the model trained is the same however many workers there are.
+"""
+
+# the lines of a corpus made into examples at a time, e.g. whose LM features are looked up in the table at once
+BATCH_LINES = 1024
+
+TEST_RATIO = 0.1
+
+CRF_PARAMS = {
+    'c1': 1.0,                            # coefficient for L1 penalty
+    'c2': 1e-3,                           # coefficient for L2 penalty
+    'max_iterations': 50,                 # stop earlier
+    'feature.possible_transitions': True  # include transitions that are possible, but not observed
+}
+
+# the tag evaluated in place of the ignored tags, not reported
+NO_TAG = ''
+
+# the hash range the test ratio is a fraction of
+HASH_RANGE = 2 ** 32
+
+
+def is_test(example_id, test_ratio=TEST_RATIO):
+    """ Whether the example of the id is held out, deterministic across runs and machines. """
+    return zlib.crc32(str(example_id).encode('ascii')) < test_ratio * HASH_RANGE
+
+
+def split_data(X, Y, test_ratio=TEST_RATIO):
+    """ Splits the lists of the features and tags of the examples into the training and test sets. """
+    train_x, train_y, test_x, test_y = [], [], [], []
+    for i, (x, y) in enumerate(zip(X, Y)):
+        if is_test(i, test_ratio):
+            test_x.append(x)
+            test_y.append(y)
+        else:
+            train_x.append(x)
+            train_y.append(y)
+    return train_x, train_y, test_x, test_y
+
+
+def iter_examples(tagger, lines, workers=1, batch_lines=BATCH_LINES):
+    """ Yields the examples of the lines, made by tagger.batch_examples() of batches of lines, by a pool of workers
+        if workers is not 1, as many as cpu cores if None, in the order of the lines.
+    """
+    lines = iter(lines)
+    batches = iter(lambda: list(islice(lines, batch_lines)), [])
+    for examples in imap_batch(tagger, 'batch_examples', batches, workers, 1):
+        for example in examples:
+            yield example
+
+
+def make_trainer(params=None):
+    import pycrfsuite
+
+    trainer = pycrfsuite.Trainer(verbose=False)
+    trainer.set_params(dict(CRF_PARAMS, **(params or {})))
+    return trainer
+
+
+def train(examples, out_model, params=None):
+    """ Trains a CRF model of the (features, tags) examples, the params update CRF_PARAMS. """
+    trainer = make_trainer(params)
+    for x, y in examples:
+        if x and y:
+            trainer.append(x, y)
+
+    trainer.train(out_model)
+    print(trainer.logparser.last_iteration)
+
+
+def write_examples(examples, f):
+    for example in examples:
+        pickle.dump(example, f, pickle.HIGHEST_PROTOCOL)
+
+
+def read_examples(test_f):
+    with open(test_f, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def train_stream(examples, out_model, params=None, test_ratio=TEST_RATIO, temp_dir=None):
+    """ Trains a CRF model of a stream of (features, tags) examples, the held-out examples are written into a temp
+        file in temp_dir, whose path is returned, to be evaluated with evaluate(read_examples(test_f), ...) and
+        removed by the caller.
+    """
+    trainer = make_trainer(params)
+    fd, test_f = tempfile.mkstemp(prefix='jiayan.', suffix='.test', dir=temp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for i, (x, y) in enumerate(examples):
+                if not (x and y):
+                    continue
+                if is_test(i, test_ratio):
+                    write_examples([(x, y)], f)
+                else:
+                    trainer.append(x, y)
+
+        trainer.train(out_model)
+        print(trainer.logparser.last_iteration)
+    except BaseException:
+        os.remove(test_f)
+        raise
+    return test_f
+
+
+def evaluate(examples, crf_model, ignored_tags=()):
+    """ Prints the classification report of the tags of a stream of (features, tags) examples tagged by the model,
+        without the ignored tags: a true or predicted ignored tag is taken as a tag of no class, and the positions of
+        ignored tags both true and predicted are dropped.
+    """
+    import pycrfsuite
+    from sklearn.metrics import classification_report
+    from sklearn.preprocessing import LabelBinarizer
+
+    tagger = pycrfsuite.Tagger()
+    tagger.open(crf_model)
+
+    # only the tags are kept, not the features
+    y_trues = []
+    y_preds = []
+    for x, y in examples:
+        y_trues.extend(y)
+        y_preds.extend(tagger.tag(x))
+    if ignored_tags:
+        pairs = [(true, pred) for true, pred in zip(y_trues, y_preds)
+                 if true not in ignored_tags or pred not in ignored_tags]
+        y_trues = [NO_TAG if true in ignored_tags else true for true, _ in pairs]
+        y_preds = [NO_TAG if pred in ignored_tags else pred for _, pred in pairs]
+
+    lb = LabelBinarizer()
+    y_true_all = lb.fit_transform(y_trues)
+    y_pred_all = lb.transform(y_preds)
+
+    tagset = sorted(set(lb.classes_) - {NO_TAG})
+    class_indices = {cls: idx for idx, cls in enumerate(lb.classes_)}
+
+    print(classification_report(
+        y_true_all,
+        y_pred_all,
+        labels=[class_indices[cls] for cls in tagset],
+        target_names=tagset,
+        digits=5
+    ))
+
+
+def train_file(tagger, data_file, out_model, params=None, test_ratio=TEST_RATIO, temp_dir=None, workers=1):
+    """ Trains the CRF model of a tagger on a corpus file, streaming the examples of tagger.iter_data(), made by a
+        pool of workers if workers is not 1, then evaluates it on the held-out examples.
+    """
+    test_f = train_stream(tagger.iter_data(data_file, workers), out_model, params, test_ratio, temp_dir)
+    try:
+        evaluate(read_examples(test_f), out_model, tagger.EVAL_IGNORED_TAGS)
+    finally:
+        os.remove(test_f)
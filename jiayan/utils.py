@@ -12,20 +12,26 @@ def process_line(line: str):
     return line
 
 
+def line_texts(line: str, keep_punc=False):
+    """ Yields the clean zh char texts of a line. """
+    for seg in line.strip().split():
+        if seg:
+            seg = process_line(seg)
+            if keep_punc:
+                if seg:
+                    yield seg
+            else:
+                for text in re_zh_exclude.findall(seg):
+                    if text:
+                        yield text
+
+
 def text_iterator(data_file, keep_punc=False):
     """ A help function to provide clean zh char lines of a given file. """
     with open(data_file, 'r', encoding='utf-8') as f:
         for line in f:
-            for seg in line.strip().split():
-                if seg:
-                    seg = process_line(seg)
-                    if keep_punc:
-                        if seg:
-                            yield seg
-                    else:
-                        for text in re_zh_exclude.findall(seg):
-                            if text:
-                                yield text
+            for text in line_texts(line, keep_punc):
+                yield text
 
 
 def make_kenlm(data_file):
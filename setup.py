@@ -5,7 +5,7 @@ import sys
 from setuptools import setup, find_packages
 
 
-requirements = ["scikit-learn", "python-crfsuite"]
+requirements = ["numpy", "scikit-learn", "python-crfsuite"]
 
 if sys.version_info[:2] < (2, 7):
     requirements.append('argparse')
@@ -36,6 +36,9 @@ setup(
     extras_require=extras_require,
     python_requires='>=2.6, >=3',
     include_package_data=True,
+    entry_points={
+        'console_scripts': ['jiayan=jiayan.__main__:main'],
+    },
     classifiers=[
         'Programming Language :: Python',
         'Programming Language :: Python :: 2',